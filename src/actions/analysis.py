@@ -1,25 +1,134 @@
 import cv2
-import numpy
-from concurrent.futures import Future, ThreadPoolExecutor, as_completed
-from glob import glob
+import hashlib
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from os import cpu_count, path as os_path
 from threading import Lock
 from time import perf_counter
 
 from arguments.parsers import Arguments
-from arguments.types import VALID_IMAGE_EXTS # TODO: should be handled differently
 from data.cache import Cache
+from data.manifest import Manifest
 from data.palette import Palette
-from utils.colors import colors_to_key, clamp_color
+from utils.colors import clamp_colors, vector_to_key
+from utils.files import file_fingerprint, iter_image_paths
+from utils.matching import find_closer_keys
+from utils.metrics import Metrics, metrics
+from utils.processes import open_worker_pool
 from utils.progress import Progress
 from .base import Action
 
+# Amount of images analyzed per worker call
+BATCH_SIZE = 32
+# Amount of batches queued per worker, before scanning waits for analysis to catch up
+PENDING_BATCHES_PER_WORKER = 4
+# Smallest cell size in a reduced decode, for its average color to stay representative
+MIN_CELL_SIZE = 16
+JPEG_EXTS = ("jpeg", "jpg", "jpe")
+REDUCED_READ_FLAGS = (
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+
+def read_img(path: str, density: int) -> cv2.Mat | None:
+    if os_path.splitext(path)[1][1:].lower() not in JPEG_EXTS:
+        return cv2.imread(path)
+
+    # JPEGs can be decoded at a fraction of their size, which is far cheaper
+    min_size = density * MIN_CELL_SIZE
+    img = cv2.imread(path, cv2.IMREAD_REDUCED_COLOR_8)
+    if img is None or min(img.shape[:2]) >= min_size:
+        return img
+
+    for factor, flag in REDUCED_READ_FLAGS:
+        if min(img.shape[:2]) * 8 // factor >= min_size:
+            return cv2.imread(path, flag)
+    return cv2.imread(path)
+
+
+def img_to_key(img: cv2.Mat, density: int, complexity: int) -> str:
+    # Area interpolation averages every cell of the image in one go
+    cells = cv2.resize(img, (density, density), interpolation=cv2.INTER_AREA)
+    return vector_to_key(clamp_colors(cells.reshape(-1), complexity))
+
+
+def file_digest(path: str) -> str:
+    with open(path, "rb") as file:
+        return hashlib.file_digest(file, "blake2b").hexdigest()
+
+
+def analyze_imgs(paths: list[str], density: int, complexity: int, digest: bool) -> tuple[list[tuple[str, str, str]], dict]:
+    # Metrics of worker processes aren't shared with the parent, so each batch collects its own
+    batch_metrics = Metrics()
+    batch_metrics.enable()
+
+    results = []
+    for path in paths:
+        with batch_metrics.timer("analyze.decode"):
+            img = read_img(path, density)
+
+        # Unreadable images are counted, but not added to the palette
+        img_key = None
+        if img is None:
+            batch_metrics.count("analyze.unreadable")
+        else:
+            with batch_metrics.timer("analyze.key"):
+                img_key = img_to_key(img, density, complexity)
+
+        file_hash = None
+        if digest:
+            with batch_metrics.timer("analyze.digest"):
+                file_hash = file_digest(path)
+        results.append((img_key, path, file_hash))
+    return results, batch_metrics.snapshot()
+
+
+def add_img(palette: Palette, cache: Cache, manifest: Manifest, path: str, img_key: str | None, fingerprint: dict, digest: str | None) -> bool:
+    # Returns whether the key is new to the palette, since cached colors may be closer to it
+    manifest.set(path, fingerprint | {"hash": digest, "key": img_key})
+    if img_key is None:
+        return False
+
+    img_list = palette.get(img_key, [])
+    is_new_key = not img_list
+    if path not in img_list:
+        img_list.append(path)
+        cache.pop(img_key)
+    palette.set(img_key, img_list)
+    return is_new_key
+
+
+def refresh_cache(palette: Palette, cache: Cache, added_keys: set[str]) -> int:
+    # Cached colors that are closer to a new key would otherwise point to the old one until rebuilt
+    added_keys = sorted(key for key in added_keys if palette.get(key, []))
+    if not added_keys or not cache.data:
+        return 0
+
+    color_keys = list(cache.data.keys())
+    closest_keys = list(cache.data.values())
+    refreshed_entries = 0
+    for color_key, closest_key in find_closer_keys(color_keys, closest_keys, added_keys):
+        cache.set(color_key, closest_key)
+        refreshed_entries += 1
+    return refreshed_entries
+
 
 class Statistics:
     def __init__(self):
         self.completion_time = 0
+        self.new_imgs = 0
+        self.changed_imgs = 0
+        self.removed_imgs = 0
+        self.unchanged_imgs = 0
+        self.refreshed_entries = 0
     
     def __repr__(self) -> str:
-        return f"Completion time: {self.completion_time:.1f} sec"
+        return f"Completion time: {self.completion_time:.1f} sec\n" + \
+            f"New images: {self.new_imgs}\n" + \
+            f"Changed images: {self.changed_imgs}\n" + \
+            f"Removed images: {self.removed_imgs}\n" + \
+            f"Unchanged images: {self.unchanged_imgs}\n" + \
+            f"Refreshed cache entries: {self.refreshed_entries}"
 
 
 class Analyze(Action):
@@ -27,97 +136,173 @@ class Analyze(Action):
         self.__unpack_args(args)
 
         profile = f"{self.density} {self.complexity}"
-        self.cache = Cache(profile)
-        self.palette = Palette(profile)
-
-        self.__load_paths()
+        self.cache = Cache(profile, self.storage_type)
+        self.palette = Palette(profile, self.storage_type)
+        self.manifest = Manifest(profile, self.storage_type)
 
-        self.progress = Progress(self.path_count)
         self.stats = Statistics()
+        self.removed_keys = set[str]()
+        self.added_keys = set[str]()
+        self.__load_legacy_keys()
+
+        # The total grows while the directory is being scanned
+        self.progress = Progress(0)
 
-        self.executor = ThreadPoolExecutor(max_workers=6)
-        self.futures = list[Future]()
+        if self.processes:
+            self.executor = open_worker_pool(self.workers)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.futures = set[Future]()
         self.data_lock = Lock()
 
     def __unpack_args(self, args: Arguments):
         self.density = args.density
         self.complexity = args.complexity
+        self.storage_type = args.storage
         self.dir = args.dir
         self.recursive = args.recursive
+        self.processes = args.processes
+        self.workers = args.workers or cpu_count()
+        self.digest = args.digest
+
+    def __load_legacy_keys(self):
+        # Images analyzed before there was a manifest are still in the palette
+        self.legacy_keys = dict[str, str]()
+        for key, img_list in self.palette.data.items():
+            for path in img_list:
+                if self.manifest.get(path, None) is None:
+                    self.legacy_keys[path] = key
+
+    def __needs_analysis(self, path: str) -> bool:
+        fingerprint = file_fingerprint(path)
+        entry = self.manifest.get(path, None)
+
+        if entry is None:
+            if path in self.legacy_keys:
+                self.manifest.set(path, fingerprint | {"hash": None, "key": self.legacy_keys[path]})
+                self.stats.unchanged_imgs += 1
+                return False
+            self.stats.new_imgs += 1
+        elif self.__is_unchanged(path, entry, fingerprint):
+            self.stats.unchanged_imgs += 1
+            return False
+        else:
+            self.__remove_path(path, entry["key"])
+            self.stats.changed_imgs += 1
+
+        self.fingerprints[path] = fingerprint
+        return True
+
+    def __remove_missing_paths(self, found_paths: set[str]):
+        for path in [path for path in self.manifest.data if self.__in_dir(path) and path not in found_paths]:
+            self.__remove_path(path, self.manifest.get(path, {})["key"])
+            self.stats.removed_imgs += 1
+        for path in [path for path in self.legacy_keys if self.__in_dir(path) and path not in found_paths]:
+            self.__remove_path(path, self.legacy_keys[path])
+            self.stats.removed_imgs += 1
+
+    def __is_unchanged(self, path: str, entry: dict, fingerprint: dict) -> bool:
+        if entry["size"] == fingerprint["size"] and entry["mtime"] == fingerprint["mtime"]:
+            return True
+        if not self.digest or entry["hash"] is None or entry["size"] != fingerprint["size"]:
+            return False
 
-    def __load_paths(self) -> set:
-        paths = set()
+        # Files that were only touched don't need to be analyzed again
+        if file_digest(path) != entry["hash"]:
+            return False
+        self.manifest.set(path, entry | fingerprint)
+        return True
 
-        for ext in VALID_IMAGE_EXTS:
-            if self.recursive:
-                new_paths = glob(f"{self.dir}/**/*.{ext}", recursive=True)
-            else:
-                new_paths = glob(f"{self.dir}/*.{ext}", recursive=False)
-            paths.update(new_paths)
-        paths.difference_update(self.palette.paths)
+    def __in_dir(self, path: str) -> bool:
+        rel_path = os_path.relpath(path, self.dir)
+        if rel_path.startswith(os_path.pardir):
+            return False
+        return self.recursive or os_path.dirname(rel_path) == ""
 
-        self.paths = paths
-        self.path_count = len(paths)
+    def __remove_path(self, path: str, img_key: str | None):
+        self.manifest.pop(path)
+        if img_key is not None and self.palette.remove(img_key, path):
+            self.removed_keys.add(img_key)
 
     def run(self):
-        print(self.progress, end="\r")
-        start_time = perf_counter()
-
-        for path in self.paths:
-            future = self.executor.submit(self.__analyze_img, path)
-            self.futures.append(future)
-        for future in as_completed(self.futures):
-            end_time = perf_counter()
-            self.stats.completion_time += end_time - start_time
-            start_time = end_time
-            self.progress.increment()
-            if self.progress.current % 1000 == 0:
-                # Done in order to avoid unsaved work after crash
-                with self.data_lock:
-                    self.cache.save()
-                    self.palette.save()
-            print(self.progress, end="\r")
+        self.progress.report()
+        self.start_time = perf_counter()
 
-        print(self.progress)
-        print(self.stats)
+        # Images are analyzed while the directory is still being scanned
+        found_paths = set[str]()
+        self.fingerprints = dict[str, dict]()
+        batch = []
+        for path in iter_image_paths(self.dir, self.recursive):
+            found_paths.add(path)
+            if not self.__needs_analysis(path):
+                continue
 
-        self.cache.save()
-        self.palette.save()
+            batch.append(path)
+            self.progress.total += 1
+            if len(batch) >= BATCH_SIZE:
+                self.__submit(batch)
+                batch = []
+        if batch:
+            self.__submit(batch)
 
-    def __get_img_colors(self, img: cv2.Mat) -> list[numpy.ndarray]:
-        height, width, _ = img.shape
+        self.__remove_missing_paths(found_paths)
+        self.__wait_for_batches(0)
+        self.executor.shutdown()
+        self.__refresh_cache()
 
-        colors = []
-        for y in range(self.density):
-            start_y = round(height / self.density * y)
-            end_y = round(height / self.density * (y + 1))
+        self.progress.finish()
+        print(self.stats)
 
-            for x in range(self.density):
-                start_x = round(width / self.density * x)
-                end_x = round(width / self.density * (x + 1))
+        self.__save()
 
-                img_section = img[start_y:end_y, start_x:end_x]
-                average_color = img_section.mean(axis=(0, 1)).astype(numpy.uint8)
-                colors.append(clamp_color(average_color, self.complexity))
+    def __submit(self, batch: list[str]):
+        future = self.executor.submit(analyze_imgs, batch, self.density, self.complexity, self.digest)
+        self.futures.add(future)
+        self.__wait_for_batches(self.workers * PENDING_BATCHES_PER_WORKER)
 
-        return colors
+    def __wait_for_batches(self, max_pending: int):
+        while len(self.futures) > max_pending:
+            done, self.futures = wait(self.futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                results, batch_metrics = future.result()
+                metrics.merge(batch_metrics)
+                with self.data_lock:
+                    self.__add_results(results)
 
-    def __analyze_img(self, path: str):
-        img = cv2.imread(path)
-        img = cv2.resize(img, (self.density * 100, self.density * 100))
-        colors = self.__get_img_colors(img)
-        img_key = colors_to_key(colors)
+                end_time = perf_counter()
+                self.stats.completion_time += end_time - self.start_time
+                self.start_time = end_time
+                prev_current = self.progress.current
+                self.progress.increment(len(results))
+                if self.progress.current // 1000 != prev_current // 1000:
+                    # Done in order to avoid unsaved work after crash
+                    with self.data_lock:
+                        self.__save()
+                self.progress.report()
 
-        with self.data_lock:
-            img_list = self.palette.get(img_key, [])
-            if path not in img_list:
-                img_list.append(path)
-                self.cache.pop(img_key)
-            self.palette.set(img_key, img_list)
+    def __add_results(self, results: list[tuple[str, str, str]]):
+        for img_key, path, digest in results:
+            if add_img(self.palette, self.cache, self.manifest, path, img_key, self.fingerprints[path], digest):
+                self.added_keys.add(img_key)
 
     def cancel(self):
-        print(f"\r{self.progress}")
+        self.progress.finish()
         print(self.stats)
         self.executor.shutdown(wait=True, cancel_futures=True)
+        self.__refresh_cache()
+        self.__save()
+
+    def __refresh_cache(self):
+        self.stats.refreshed_entries += refresh_cache(self.palette, self.cache, self.added_keys)
+        self.added_keys.clear()
+
+    def __save(self):
+        # Cache entries may only point to keys that are still in the palette
+        removed_keys = {key for key in self.removed_keys if not self.palette.get(key, [])}
+        if removed_keys:
+            self.cache.pop_values(removed_keys)
+        self.removed_keys.clear()
+
         self.cache.save()
         self.palette.save()
+        self.manifest.save()
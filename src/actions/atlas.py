@@ -0,0 +1,97 @@
+import cv2
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from time import perf_counter
+
+from arguments.parsers import Arguments
+from data.atlas import Atlas as AtlasData
+from data.palette import Palette
+from utils.metrics import metrics
+from utils.progress import Progress
+from .base import Action
+
+
+class Statistics:
+    def __init__(self):
+        self.completion_time = 0
+        self.rendered_tiles = 0
+        self.failed_tiles = 0
+    
+    def __repr__(self) -> str:
+        return f"Completion time: {self.completion_time:.1f} sec\n" + \
+            f"Rendered tiles: {self.rendered_tiles}\n" + \
+            f"Failed tiles: {self.failed_tiles}"
+
+
+class Atlas(Action):
+    def __init__(self, args: Arguments):
+        self.__unpack_args(args)
+
+        profile = f"{self.density} {self.complexity}"
+        self.palette = Palette(profile, self.storage_type)
+        self.atlases = [AtlasData(profile, pixel_size) for pixel_size in self.pixel_sizes]
+
+        self.__load_paths()
+
+        self.progress = Progress(len(self.missing_paths))
+        self.stats = Statistics()
+
+        self.executor = ThreadPoolExecutor(max_workers=6)
+        self.futures = list[Future]()
+
+    def __unpack_args(self, args: Arguments):
+        self.density = args.density
+        self.complexity = args.complexity
+        self.storage_type = args.storage
+        self.pixel_sizes = sorted(set(args.pixel_sizes))
+
+    def __load_paths(self):
+        paths = sorted(self.palette.paths)
+
+        # Each image is decoded once, even if it's missing from several atlases
+        self.missing_paths = dict[str, list[AtlasData]]()
+        for atlas in self.atlases:
+            for path in atlas.begin(paths):
+                self.missing_paths.setdefault(path, []).append(atlas)
+
+    def run(self):
+        self.progress.report()
+        start_time = perf_counter()
+
+        for path, atlases in self.missing_paths.items():
+            future = self.executor.submit(self.__render_tiles, path, atlases)
+            self.futures.append(future)
+        for future in as_completed(self.futures):
+            if future.result():
+                self.stats.rendered_tiles += 1
+            else:
+                self.stats.failed_tiles += 1
+
+            end_time = perf_counter()
+            self.stats.completion_time += end_time - start_time
+            start_time = end_time
+            self.progress.increment()
+            self.progress.report()
+
+        self.progress.finish()
+        print(self.stats)
+
+        for atlas in self.atlases:
+            atlas.commit()
+
+    def __render_tiles(self, path: str, atlases: list[AtlasData]) -> bool:
+        with metrics.timer("tile.decode"):
+            img = cv2.imread(path)
+        for atlas in atlases:
+            if img is None:
+                atlas.discard(path)
+            else:
+                with metrics.timer("tile.resize"):
+                    tile = cv2.resize(img, (atlas.pixel_size, atlas.pixel_size))
+                atlas.put(path, tile)
+        return img is not None
+
+    def cancel(self):
+        # The atlases are left as they were, since their new versions are incomplete
+        self.progress.finish()
+        print(self.stats)
+        self.executor.shutdown(wait=True, cancel_futures=True)
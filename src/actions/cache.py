@@ -1,14 +1,24 @@
+import cv2
 import math
+import numpy
 import random
+from concurrent.futures import ThreadPoolExecutor
 from time import perf_counter
 from typing import Generator
 
 from arguments.parsers import Arguments
 from data.cache import Cache as CacheData
+from data.lut import LookupTable
 from data.palette import Palette
-from utils.colors import colors_to_closest_key, key_to_colors
+from utils.colors import KeyCodec, clamp_colors, img_to_block_vectors, keys_to_vectors, vector_to_key
+from utils.files import iter_image_paths
+from utils.metrics import metrics
 from utils.progress import Progress
 from .base import Action
+from .generation import fit_src_size
+
+# Amount of color keys resolved by the matcher at once
+BATCH_SIZE = 1024
 
 
 def all_single_color_keys(complexity: int) -> Generator[str, None, None]:
@@ -42,13 +52,29 @@ def all_color_keys(density: int, complexity: int) -> Generator[str, None, None]:
 
 
 def total_color_count(density: int, complexity: int) -> int:
-    per_density_count = (256 // complexity) ** 3
+    per_density_count = len(range(0, 256, complexity)) ** 3
     count = per_density_count ** (density ** 2)
     # for _ in range(density ** 2):
     #     count *= per_density_count
     return count
 
 
+def img_block_counts(path: str, codec: KeyCodec, max_size: int, density: int) -> tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray] | None:
+    img = cv2.imread(path)
+    if img is None:
+        return None
+
+    # Scaled like the sources of mosaics, since the blocks of the original size would never occur
+    height, width, _ = img.shape
+    new_height, new_width = fit_src_size(height, width, max_size, density)
+    if new_height != height or new_width != width:
+        img = cv2.resize(img, (new_width, new_height))
+
+    vectors = img_to_block_vectors(clamp_colors(img, codec.complexity), density)
+    codes, first_idxs, counts = numpy.unique(codec.encode(vectors), return_index=True, return_counts=True)
+    return codes, vectors[first_idxs], counts
+
+
 class Statistics:
     def __init__(self):
         self.completion_time = 0
@@ -57,34 +83,79 @@ class Statistics:
         return f"Completion time: {self.completion_time:.1f} sec"
 
 
+class PrewarmStatistics(Statistics):
+    def __init__(self):
+        super().__init__()
+        self.scanned_images = 0
+        self.failed_images = 0
+        self.distinct_colors = 0
+        self.cached_colors = 0
+        self.resolved_colors = 0
+        self.cached_blocks = 0.0
+
+    def __repr__(self) -> str:
+        return super().__repr__() + "\n" + \
+            f"Scanned images: {self.scanned_images}\n" + \
+            f"Failed images: {self.failed_images}\n" + \
+            f"Distinct colors: {self.distinct_colors}\n" + \
+            f"Already cached colors: {self.cached_colors}\n" + \
+            f"Resolved colors: {self.resolved_colors}\n" + \
+            f"Already cached blocks: {self.cached_blocks * 100:.1f}%"
+
+
 class Cache(Action):
     def __init__(self, args: Arguments):
         self.__unpack_args(args)
 
         profile = f"{self.density} {self.complexity}"
-        self.cache = CacheData(profile)
-        self.palette = Palette(profile)
+        self.cache = CacheData(profile, self.storage_type)
+        self.palette = Palette(profile, self.storage_type)
+        # Only the keys are matched against, so the palette is packed instead of loaded as a dict
+        self.codec = KeyCodec(self.density * self.density * 3, self.complexity)
+        self.palette.compact(self.codec)
+        self.matcher = self.palette.matcher(self.approx)
 
-        self.progress = Progress(total_color_count(self.density, self.complexity))
-        self.stats = Statistics()
+        if self.dense:
+            self.lut = LookupTable(profile, self.complexity)
+            self.progress = Progress(len(range(0, 256, self.complexity)))
+            self.stats = Statistics()
+        elif self.prewarm:
+            self.prewarm_paths = list(iter_image_paths(self.prewarm, self.recursive))
+            self.progress = Progress(len(self.prewarm_paths))
+            self.stats = PrewarmStatistics()
+        else:
+            self.progress = Progress(total_color_count(self.density, self.complexity))
+            self.stats = Statistics()
 
     def __unpack_args(self, args: Arguments):
         self.all = args.all
+        self.dense = args.dense
         self.density = args.density
         self.complexity = args.complexity
+        self.storage_type = args.storage
+        self.approx = args.approx
+        self.prewarm = args.prewarm
+        self.recursive = args.recursive
+        self.src_size = args.src_size
 
     def run(self):
-        print(self.progress, end="\r")
+        if self.dense:
+            self.__run_dense()
+            return
+        if self.prewarm:
+            self.__run_prewarm()
+            return
+
+        self.progress.report()
         start_time = perf_counter()
 
+        pending_keys = []
         for color_key in all_color_keys(self.density, self.complexity):
             if self.all or not self.cache.contains(color_key):
-                colors = key_to_colors(color_key)
-                # TODO: do not use palette's data dict directly here
-                closest_key = colors_to_closest_key(self.palette.data, colors)
-                self.cache.set(color_key, closest_key)
-                
-                if self.progress.current % 100 == 0:
+                pending_keys.append(color_key)
+                if len(pending_keys) >= BATCH_SIZE:
+                    self.__resolve(pending_keys)
+                    pending_keys.clear()
                     self.cache.save()
 
             end_time = perf_counter()
@@ -92,13 +163,114 @@ class Cache(Action):
             start_time = end_time
             
             self.progress.increment()
-            print(self.progress, end="\r")
+            self.progress.report()
+
+        self.__resolve(pending_keys)
 
-        print(self.progress)
+        self.progress.finish()
         print(self.stats)
         self.cache.save()
 
+    def __run_dense(self):
+        self.progress.report()
+        start_time = perf_counter()
+
+        # The table is indexed by quantized color, and filled one plane of the color space at a time
+        values = numpy.arange(0, 256, self.complexity, dtype=numpy.uint8)
+        table = numpy.empty((len(values),) * 3, dtype=numpy.int32)
+        plane = numpy.stack(numpy.meshgrid(values, values, indexing="ij"), axis=-1).reshape(-1, 2)
+
+        for idx, value in enumerate(values):
+            colors = numpy.column_stack((numpy.full(len(plane), value, dtype=numpy.uint8), plane))
+            with metrics.timer("cache.nearest_search"):
+                table[idx] = self.matcher.closest_indices(colors).reshape(len(values), len(values))
+
+            end_time = perf_counter()
+            self.stats.completion_time += end_time - start_time
+            start_time = end_time
+
+            self.progress.increment()
+            self.progress.report()
+
+        self.progress.finish()
+        print(self.stats)
+        self.lut.save(table, self.matcher.keys)
+
+    def __run_prewarm(self):
+        self.progress.report()
+        start_time = perf_counter()
+
+        # Decoding and scaling release the GIL, so images are scanned by threads
+        all_codes, all_vectors, all_counts = [], [], []
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            for result in executor.map(lambda path: img_block_counts(path, self.codec, self.src_size, self.density), self.prewarm_paths):
+                if result is None:
+                    self.stats.failed_images += 1
+                else:
+                    self.stats.scanned_images += 1
+                    codes, vectors, counts = result
+                    all_codes.append(codes)
+                    all_vectors.append(vectors)
+                    all_counts.append(counts)
+
+                end_time = perf_counter()
+                self.stats.completion_time += end_time - start_time
+                start_time = end_time
+                self.progress.increment()
+                self.progress.report()
+
+        vectors, counts = self.__merge_block_counts(all_codes, all_vectors, all_counts)
+        self.stats.distinct_colors = len(vectors)
+
+        # The most frequent colors are resolved first, so that an interrupted prewarm still covers the most blocks
+        order = numpy.argsort(-counts, kind="stable")
+        vectors, counts = vectors[order], counts[order]
+        self.progress.total += len(vectors)
+
+        cached_count = 0
+        for start in range(0, len(vectors), BATCH_SIZE):
+            color_keys = [vector_to_key(vector) for vector in vectors[start:start + BATCH_SIZE]]
+            batch_counts = counts[start:start + BATCH_SIZE]
+            if not self.all:
+                cached_keys = self.cache.get_many(color_keys)
+                cached = numpy.array([color_key in cached_keys for color_key in color_keys], dtype=bool)
+                self.stats.cached_colors += len(cached_keys)
+                cached_count += int(batch_counts[cached].sum())
+                color_keys = [color_key for color_key in color_keys if color_key not in cached_keys]
+
+            self.__resolve(color_keys)
+            self.cache.save()
+            self.stats.resolved_colors += len(color_keys)
+
+            end_time = perf_counter()
+            self.stats.completion_time += end_time - start_time
+            start_time = end_time
+            self.progress.increment(len(batch_counts))
+            self.progress.report()
+
+        self.stats.cached_blocks = cached_count / max(1, int(counts.sum()))
+        self.progress.finish()
+        print(self.stats)
+
+    def __merge_block_counts(self, all_codes: list, all_vectors: list, all_counts: list) -> tuple[numpy.ndarray, numpy.ndarray]:
+        if not all_codes:
+            return numpy.empty((0, self.codec.dims), dtype=numpy.uint8), numpy.empty(0, dtype=numpy.int64)
+        codes, first_idxs, inverse = numpy.unique(numpy.concatenate(all_codes), return_index=True, return_inverse=True)
+        counts = numpy.bincount(inverse.reshape(-1), weights=numpy.concatenate(all_counts), minlength=len(codes))
+        return numpy.concatenate(all_vectors)[first_idxs], counts.astype(numpy.int64)
+
+    def __resolve(self, color_keys: list[str]):
+        if not color_keys:
+            return
+        with metrics.timer("cache.nearest_search"):
+            closest_keys = self.matcher.closest_keys(keys_to_vectors(color_keys))
+        metrics.count("cache.resolved_keys", len(color_keys))
+        for color_key, closest_key in zip(color_keys, closest_keys):
+            self.cache.set(color_key, closest_key)
+
     def cancel(self):
-        print(f"\r{self.progress}")
+        self.progress.finish()
         print(self.stats)
-        self.cache.save()
+        # An incomplete lookup table is useless, so only the string cache is kept
+        if not self.dense:
+            self.cache.save()
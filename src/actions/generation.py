@@ -4,145 +4,659 @@ import shutil
 import cv2
 import numpy
 from concurrent.futures import Future, ThreadPoolExecutor, as_completed
-from threading import Lock
+from contextlib import redirect_stdout
+from io import StringIO
+from multiprocessing.shared_memory import SharedMemory
+from os import cpu_count, makedirs, path as os_path
+from threading import Lock, Semaphore
 from time import perf_counter
+from typing import Callable
 
 from arguments.parsers import Arguments
-from data.cache import Cache
+from data.atlas import Atlas
+from data.cache import Cache, closest_idxs
+from data.lut import LookupTable
 from data.palette import Palette
-from utils.colors import colors_to_key, colors_to_closest_key, clamp_color
+from data.snapshot import Snapshot
+from utils.colors import KeyCodec, clamp_colors, img_to_block_vectors, vector_to_key
+from utils.metrics import metrics
+from utils.pipeline import POLL_INTERVAL, Pipeline, Stage
+from utils.processes import open_worker_pool
 from utils.progress import Progress
+from utils.streaming import open_band_writer
+from utils.tiles import TileCache
+from utils.video import DEFAULT_FPS, open_video_writer
 from .base import Action
 
 # TODO: rougher color precision could speed up caching, analysis, and generation
 
+# Upper bound of memory used by a single band of a streamed mosaic
+BAND_MAX_BYTES = 64 * 1024 * 1024
+# Amount of bands of a streamed mosaic in memory at once, so that one can be filled while the previous is finished
+MAX_LIVE_BANDS = 2
+# Max amount of pixels waiting between two stages of generation
+QUEUE_SIZE = 1024
+# Amount of bands a mosaic is split into per worker process
+BANDS_PER_WORKER = 4
+
 
 class Statistics:
     def __init__(self):
         self.completion_time = 0
+        self.mosaics = 0
+        self.reused_blocks = 0
         self.cached_entries = 0
-        # TODO: add time per pixel array
-    
+        self.tile_hits = 0
+        self.tile_misses = 0
+        self.atlas_hits = 0
+
     def __repr__(self) -> str:
         return f"Completion time: {self.completion_time:.1f} sec\n" + \
-            f"Cached entries: {self.cached_entries}"
+            f"Mosaics: {self.mosaics}\n" + \
+            f"Reused blocks: {self.reused_blocks}\n" + \
+            f"Cached entries: {self.cached_entries}\n" + \
+            f"Tile cache hits: {self.tile_hits}\n" + \
+            f"Tile cache misses: {self.tile_misses}\n" + \
+            f"Atlas hits: {self.atlas_hits}"
 
 
-class Generate(Action):
+def fit_src_size(height: int, width: int, max_size: int, density: int) -> tuple[int, int]:
+    # Decides new size of image
+    scale_factor = max_size / max(height, width)
+    new_height, new_width = height, width
+    if scale_factor < 1:
+        new_height = round(height * scale_factor)
+        new_width = round(width * scale_factor)
+
+    # Ensures divisible by density
+    if diff := new_height % density:
+        new_height += density - diff
+    if diff := new_width % density:
+        new_width += density - diff
+    return new_height, new_width
+
+
+def read_src(src: str | numpy.ndarray, max_size: int, density: int) -> numpy.ndarray:
+    if isinstance(src, str):
+        path = src
+        with metrics.timer("generate.src_decode"):
+            src = cv2.imread(path)
+        if src is None:
+            raise OSError(f"{path} could not be read")
+    height, width, _ = src.shape
+    new_height, new_width = fit_src_size(height, width, max_size, density)
+
+    # Apply new size of image
+    if new_height != height or new_width != width:
+        with metrics.timer("generate.src_resize"):
+            src = cv2.resize(src, (new_width, new_height))
+    return src
+
+
+class Resources:
+    # Everything that is shared by the mosaics of a profile
     def __init__(self, args: Arguments):
         self.__unpack_args(args)
-        self.__load_src()
-        self.__load_dst()
 
         profile = f"{self.density} {self.complexity}"
-        self.cache = Cache(profile)
-        self.palette = Palette(profile)
-
-        self.progress = Progress(self.src_height // self.density * self.src_width // self.density)
-        self.stats = Statistics()
+        self.cache = Cache(profile, self.storage_type)
+        self.palette = Palette(profile, self.storage_type)
+        self.codec = KeyCodec(self.density * self.density * 3, self.complexity)
+        self.snapshot = Snapshot(profile, self.codec)
+        if self.snapshot.load(self.palette.path, self.palette.storage.version()):
+            self.compact = self.snapshot.palette
+            self.matcher = self.snapshot.matcher(self.approx)
+            self.matcher_idxs = numpy.arange(len(self.compact))
+            self.compact_cache = self.snapshot.cache
+        else:
+            # Packed before anything else asks for keys, so that the palette is never loaded as a dict
+            self.compact = self.palette.compact(self.codec)
+            self.matcher = self.palette.matcher(self.approx)
+            self.matcher_idxs = self.compact.index_of(self.matcher.keys)
+            # Packed up front, since mosaics are resolved from several threads
+            self.compact_cache = self.cache.compact(self.codec, self.compact)
+        self.lut = self.__load_lut(profile)
+        self.atlas = Atlas(profile, self.pixel_size)
+        self.tiles = TileCache(self.tile_cache_size * 1024 * 1024, self.atlas)
 
-        self.executor = ThreadPoolExecutor(max_workers=6)
-        self.futures = list[Future]()
         self.cache_lock = Lock()
-        self.stats_lock = Lock()
+        self.cached_entries = 0
 
     def __unpack_args(self, args: Arguments):
         self.density = args.density
         self.complexity = args.complexity
-        self.src_path = args.src
-        self.dst_path = args.dst
-        self.src_max_size = args.src_size
+        self.storage_type = args.storage
+        self.approx = args.approx
         self.pixel_size = args.pixel_size
+        self.tile_cache_size = args.tile_cache_size
 
-    def __load_src(self):
-        src = cv2.imread(self.src_path)
+    def __load_lut(self, profile: str) -> LookupTable | None:
+        if self.density != 1:
+            return None
+        lut = LookupTable(profile, self.complexity)
+        if not lut.matches(self.compact.keys):
+            return None
+        self.lut_idxs = self.compact.index_of(lut.keys)
+        return lut
+
+    def resolve(self, src: numpy.ndarray) -> tuple[numpy.ndarray, list[list]]:
         height, width, _ = src.shape
+        vectors = img_to_block_vectors(clamp_colors(src, self.complexity), self.density)
+        inverse, img_lists = self.resolve_vectors(vectors)
+        blocks = inverse.reshape(height // self.density, width // self.density)
+        return blocks, img_lists
+
+    def resolve_vectors(self, vectors: numpy.ndarray) -> tuple[numpy.ndarray, list[list]]:
+        with metrics.timer("generate.key_lookup"):
+            return self.__resolve_vectors(vectors)
+
+    def __resolve_vectors(self, vectors: numpy.ndarray) -> tuple[numpy.ndarray, list[list]]:
+        if self.lut is not None:
+            # Pixels map straight to palette keys, without building any color keys
+            key_idxs = self.lut_idxs[self.lut.lookup(vectors)]
+            unique_idxs, inverse = numpy.unique(key_idxs, return_inverse=True)
+            img_lists = [self.compact.img_list(idx) for idx in unique_idxs.tolist()]
+        else:
+            # Every distinct block is only resolved once, no matter how often it occurs
+            unique_vectors, inverse = numpy.unique(vectors, axis=0, return_inverse=True)
+            img_lists = self.__resolve_unique_vectors(unique_vectors)
+        return inverse.reshape(-1), img_lists
+
+    def __resolve_unique_vectors(self, vectors: numpy.ndarray) -> list[list]:
+        codes = self.codec.encode(vectors)
+        key_idxs = self.compact.find(codes)
+        palette_count = int((key_idxs >= 0).sum())
+
+        # Cached keys that are no longer in the palette are resolved again
+        missing_idxs = numpy.flatnonzero(key_idxs < 0)
+        key_idxs[missing_idxs] = self.compact_cache.find(codes[missing_idxs])
+        missing_idxs = numpy.flatnonzero(key_idxs < 0)
+        if self.snapshot.cache is not None and len(missing_idxs):
+            key_idxs[missing_idxs] = self.__find_stored(vectors[missing_idxs], codes[missing_idxs])
+            missing_idxs = numpy.flatnonzero(key_idxs < 0)
+
+        metrics.count("generate.palette_hit", palette_count)
+        metrics.count("generate.cache_hit", len(vectors) - palette_count - len(missing_idxs))
+        metrics.count("generate.cache_miss", len(missing_idxs))
+
+        # Closest keys should be valid, since they're found via the palette
+        with metrics.timer("generate.nearest_search"):
+            closest_idxs = self.matcher_idxs[self.matcher.closest_indices(vectors[missing_idxs])]
+        key_idxs[missing_idxs] = closest_idxs
+        with self.cache_lock:
+            self.compact_cache.set(codes[missing_idxs], closest_idxs)
+            for idx, closest_idx in zip(missing_idxs.tolist(), closest_idxs.tolist()):
+                self.cache.set(vector_to_key(vectors[idx]), self.compact.key(closest_idx))
+                self.cached_entries += 1
+
+        return [self.compact.img_list(idx) for idx in key_idxs.tolist()]
+
+    def __find_stored(self, vectors: numpy.ndarray, codes: numpy.ndarray) -> numpy.ndarray:
+        # Entries cached since the snapshot was saved are only in storage
+        color_keys = [vector_to_key(vector) for vector in vectors]
+        with self.cache_lock:
+            entries = self.cache.get_many(color_keys)
+        key_idxs = closest_idxs(self.compact, color_keys, [entries.get(color_key) for color_key in color_keys])
+
+        found = key_idxs >= 0
+        with self.cache_lock:
+            self.compact_cache.set(codes[found], key_idxs[found])
+        return key_idxs
+
+    def tile(self, img_list: list, pixel_size: int) -> numpy.ndarray:
+        return self.tiles.get(random.choice(img_list), pixel_size)
+
+    def save(self):
+        with self.cache_lock:
+            self.cache.save()
+
+
+def fetch_tile(resources: Resources, img_list: list, pixel_size: int) -> numpy.ndarray:
+    with metrics.timer("generate.fetch"):
+        return resources.tile(img_list, pixel_size)
+
+
+def blit_tile(dst: numpy.ndarray, x: int, y: int, tile: numpy.ndarray, pixel_size: int):
+    dest_y = y * pixel_size
+    dest_x = x * pixel_size
+    with metrics.timer("generate.blit"):
+        dst[dest_y:dest_y + pixel_size, dest_x:dest_x + pixel_size] = tile[0:pixel_size, 0:pixel_size]
 
-        # Decides new size of image
-        scale_factor = self.src_max_size / max(height, width)
-        new_height, new_width = height, width
-        if scale_factor < 1:
-            new_height = round(height * scale_factor)
-            new_width = round(width * scale_factor)
-
-        # Ensures divisible by density
-        if diff := new_height % self.density:
-            new_height += self.density - diff
-        if diff := new_width % self.density:
-            new_width += self.density - diff
-
-        # Apply new size of image
-        if new_height != height or new_width != width:
-            src = cv2.resize(src, (new_width, new_height))
 
+class Mosaic:
+    # Sources may also be decoded images, and mosaics without a destination are only kept in memory
+    def __init__(self, resources: Resources, src: str | numpy.ndarray, dst_path: str | None, args: Arguments):
+        self.resources = resources
         self.src = src
+        self.dst_path = dst_path
+        self.__unpack_args(args)
+        self.__load_src()
+        self.__load_dst()
+        self.cancelled = False
+
+        # Tiles are decoded and blitted by separate pools, connected by bounded queues
+        self.pipeline = Pipeline([
+            Stage(self.__fetch_tile, self.fetch_workers),
+            Stage(self.__blit_tile, self.blit_workers),
+        ], QUEUE_SIZE)
+
+    def __unpack_args(self, args: Arguments):
+        self.density = args.density
+        self.src_max_size = args.src_size
+        self.pixel_size = args.pixel_size
+        self.stream = args.stream
+        self.fetch_workers = args.fetch_workers
+        self.blit_workers = args.blit_workers
+
+    def __load_src(self):
+        self.src = read_src(self.src, self.src_max_size, self.density)
         self.src_height, self.src_width, _ = self.src.shape
+        self.total = self.src_height // self.density * self.src_width // self.density
 
     def __load_dst(self):
         self.dst_height = self.src_height // self.density * self.pixel_size
         self.dst_width = self.src_width // self.density * self.pixel_size
-        dst_shape = (self.dst_height, self.dst_width, 3)
-        self.dst = numpy.zeros(shape=dst_shape, dtype=numpy.uint8)
+        if self.stream:
+            # Only a band of the mosaic is kept in memory at a time
+            self.dst = None
+            row_bytes = self.pixel_size * self.dst_width * 3
+            self.band_rows = max(1, BAND_MAX_BYTES // row_bytes)
+        else:
+            dst_shape = (self.dst_height, self.dst_width, 3)
+            self.dst = numpy.zeros(shape=dst_shape, dtype=numpy.uint8)
 
-    def run(self):
-        print(self.progress, end="\r")
-        start_time = perf_counter()
+    def run(self, on_done: Callable[[], None]) -> numpy.ndarray | None:
+        self.on_done = on_done
+        blocks, img_lists = self.resources.resolve(self.src)
+        self.__fill(blocks, img_lists)
+
+        # A cancelled mosaic is left unfinished, so it shouldn't replace the destination
+        if not self.stream and self.dst_path is not None and not self.cancelled:
+            with metrics.timer("generate.write"):
+                if not cv2.imwrite(self.dst_path, self.dst):
+                    raise OSError(f"{self.dst_path} could not be written")
+        return self.dst
+
+    def __fill(self, blocks: numpy.ndarray, img_lists: list[list]):
+        # Without streaming, every band is simply a view into the full mosaic
+        band_rows = self.band_rows if self.stream else len(blocks)
+        self.bands = dict[int, list]()
+        self.bands_lock = Lock()
+        self.next_band = 0
+        self.writer = open_band_writer(self.dst_path, self.dst_width, self.dst_height) if self.stream else None
+        # The queues hold far more tiles than a band, so bands are only allocated once earlier ones are written
+        self.live_bands = Semaphore(MAX_LIVE_BANDS)
+
+        def jobs():
+            for band_idx, band_start in enumerate(range(0, len(blocks), band_rows)):
+                band_blocks = blocks[band_start:band_start + band_rows]
+                if self.stream:
+                    while not self.live_bands.acquire(timeout=POLL_INTERVAL):
+                        if self.pipeline.stopped:
+                            return
+                    band = numpy.zeros((len(band_blocks) * self.pixel_size, self.dst_width, 3), dtype=numpy.uint8)
+                else:
+                    band = self.dst[band_start * self.pixel_size:(band_start + len(band_blocks)) * self.pixel_size]
+                with self.bands_lock:
+                    self.bands[band_idx] = [band, band_blocks.size]
+
+                for y, row in enumerate(band_blocks.tolist()):
+                    for x, unique_idx in enumerate(row):
+                        yield band_idx, band, x, y, img_lists[unique_idx]
+
+        finished = False
+        try:
+            self.pipeline.run(jobs(), self.__on_pixel_done)
+            finished = not self.cancelled
+        finally:
+            if self.writer is not None:
+                if finished:
+                    self.writer.close()
+                else:
+                    self.writer.discard()
+
+    def __fetch_tile(self, job: tuple) -> tuple:
+        band_idx, band, x, y, img_list = job
+        return band_idx, band, x, y, fetch_tile(self.resources, img_list, self.pixel_size)
+
+    def __blit_tile(self, job: tuple) -> int:
+        band_idx, band, x, y, tile = job
+        blit_tile(band, x, y, tile, self.pixel_size)
+        return band_idx
+
+    def __on_pixel_done(self, band_idx: int):
+        self.on_done()
+
+        with self.bands_lock:
+            self.bands[band_idx][1] -= 1
+            # Bands can finish out of order, but have to be written in order
+            while self.next_band in self.bands and self.bands[self.next_band][1] == 0:
+                band, _ = self.bands.pop(self.next_band)
+                if self.writer is not None:
+                    with metrics.timer("generate.write"):
+                        self.writer.write(band)
+                    self.live_bands.release()
+                self.next_band += 1
+
+    def cancel(self):
+        self.cancelled = True
+        self.pipeline.cancel()
+
+
+class VideoMosaic:
+    def __init__(self, resources: Resources, src_path: str, dst_path: str, args: Arguments):
+        self.resources = resources
+        self.src_path = src_path
+        self.dst_path = dst_path
+        self.__unpack_args(args)
+        self.__open_src()
+
+        self.dst_height = self.src_height // self.density * self.pixel_size
+        self.dst_width = self.src_width // self.density * self.pixel_size
+        # Kept between frames, so that unchanged blocks don't have to be drawn again
+        self.dst = numpy.zeros(shape=(self.dst_height, self.dst_width, 3), dtype=numpy.uint8)
+        self.reused_blocks = 0
+        self.cancelled = False
+
+        self.pipeline = Pipeline([
+            Stage(self.__fetch_tile, self.fetch_workers),
+            Stage(self.__blit_tile, self.blit_workers),
+        ], QUEUE_SIZE)
+
+    def __unpack_args(self, args: Arguments):
+        self.density = args.density
+        self.src_max_size = args.src_size
+        self.pixel_size = args.pixel_size
+        self.fetch_workers = args.fetch_workers
+        self.blit_workers = args.blit_workers
 
-        for y in range(0, self.src_height, self.density):
-            for x in range(0, self.src_width, self.density):
-                future = self.executor.submit(self.__fill_pixel, x, y)
+    def __open_src(self):
+        self.capture = cv2.VideoCapture(self.src_path)
+        if not self.capture.isOpened():
+            raise OSError(f"{self.src_path} could not be opened")
+
+        height = int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        width = int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.src_height, self.src_width = fit_src_size(height, width, self.src_max_size, self.density)
+        self.fps = self.capture.get(cv2.CAP_PROP_FPS) or DEFAULT_FPS
+        # Progress is counted in frames, since most blocks are carried over between them
+        self.total = max(0, int(self.capture.get(cv2.CAP_PROP_FRAME_COUNT)))
+
+    def run(self, on_done: Callable[[], None]):
+        writer = open_video_writer(self.dst_path, self.fps, self.dst_width, self.dst_height)
+        prev_vectors = None
+        try:
+            while not self.cancelled:
+                with metrics.timer("generate.src_decode"):
+                    read, frame = self.capture.read()
+                if not read:
+                    break
+                if frame.shape[:2] != (self.src_height, self.src_width):
+                    with metrics.timer("generate.src_resize"):
+                        frame = cv2.resize(frame, (self.src_width, self.src_height))
+
+                vectors = img_to_block_vectors(clamp_colors(frame, self.resources.complexity), self.density)
+                if prev_vectors is None:
+                    changed_idxs = numpy.arange(len(vectors))
+                else:
+                    # Only blocks whose clamped colors changed are resolved and drawn again
+                    changed_idxs = numpy.flatnonzero((vectors != prev_vectors).any(axis=1))
+                prev_vectors = vectors
+                self.reused_blocks += len(vectors) - len(changed_idxs)
+                metrics.count("generate.reused_blocks", len(vectors) - len(changed_idxs))
+
+                if len(changed_idxs):
+                    self.__draw(changed_idxs, vectors[changed_idxs])
+                if not self.cancelled:
+                    with metrics.timer("generate.write"):
+                        writer.write(self.dst)
+                    on_done()
+        finally:
+            writer.release()
+            self.capture.release()
+
+    def __draw(self, block_idxs: numpy.ndarray, vectors: numpy.ndarray):
+        inverse, img_lists = self.resources.resolve_vectors(vectors)
+        blocks_width = self.src_width // self.density
+
+        def jobs():
+            for block_idx, unique_idx in zip(block_idxs.tolist(), inverse.tolist()):
+                y, x = divmod(block_idx, blocks_width)
+                yield x, y, img_lists[unique_idx]
+
+        self.pipeline.run(jobs(), lambda _: None)
+
+    def __fetch_tile(self, job: tuple) -> tuple:
+        x, y, img_list = job
+        return x, y, fetch_tile(self.resources, img_list, self.pixel_size)
+
+    def __blit_tile(self, job: tuple) -> bool:
+        x, y, tile = job
+        blit_tile(self.dst, x, y, tile, self.pixel_size)
+        return True
+
+    def cancel(self):
+        self.cancelled = True
+        self.pipeline.cancel()
+
+
+# Resources of a worker process, loaded once when its pool starts it
+worker_resources: Resources = None
+
+
+def init_band_worker(args: Arguments):
+    global worker_resources
+    if args.metrics:
+        metrics.enable()
+    with redirect_stdout(StringIO()):
+        worker_resources = Resources(args)
+
+
+def generate_band(shm_name: str, dst_shape: tuple, band_start: int, src_band: numpy.ndarray, pixel_size: int) -> tuple[int, dict, tuple, dict]:
+    # Runs in a worker process, so whatever it finds is returned for the parent to merge and save
+    resources = worker_resources
+    tiles = resources.tiles
+    tile_counts = (tiles.hits, tiles.misses, tiles.atlas_hits)
+
+    shm = SharedMemory(name=shm_name)
+    try:
+        dst = numpy.ndarray(dst_shape, dtype=numpy.uint8, buffer=shm.buf)
+        blocks, img_lists = resources.resolve(src_band)
+        for y, row in enumerate(blocks.tolist(), band_start):
+            for x, unique_idx in enumerate(row):
+                blit_tile(dst, x, y, fetch_tile(resources, img_lists[unique_idx], pixel_size), pixel_size)
+        # The buffer can't be closed while it's still viewed
+        del dst
+    finally:
+        shm.close()
+
+    with resources.cache_lock:
+        entries = resources.cache.take_updates()
+    tile_counts = (tiles.hits - tile_counts[0], tiles.misses - tile_counts[1], tiles.atlas_hits - tile_counts[2])
+    return blocks.size, entries, tile_counts, metrics.snapshot(clear=True)
+
+
+class BandPool:
+    # Worker processes that each load the resources once, and generate bands of mosaics into shared memory
+    def __init__(self, args: Arguments):
+        self.__unpack_args(args)
+
+        profile = f"{self.density} {self.complexity}"
+        # Only entries found by the workers are saved from here, so nothing else has to be loaded
+        self.cache = Cache(profile, self.storage_type)
+        self.lock = Lock()
+        self.cached_keys = set[str]()
+        self.cached_entries = 0
+        self.tile_hits = 0
+        self.tile_misses = 0
+        self.atlas_hits = 0
+
+        self.executor = open_worker_pool(self.workers, init_band_worker, (args,))
+
+    def __unpack_args(self, args: Arguments):
+        self.density = args.density
+        self.complexity = args.complexity
+        self.storage_type = args.storage
+        self.workers = args.workers or cpu_count()
+
+    def add_results(self, entries: dict, tile_counts: tuple, band_metrics: dict):
+        metrics.merge(band_metrics)
+        with self.lock:
+            # Workers may have found the same colors in different bands
+            for color_key, closest_key in entries.items():
+                if color_key not in self.cached_keys:
+                    self.cached_keys.add(color_key)
+                    self.cache.set(color_key, closest_key)
+            self.cached_entries = len(self.cached_keys)
+            self.tile_hits += tile_counts[0]
+            self.tile_misses += tile_counts[1]
+            self.atlas_hits += tile_counts[2]
+
+    def save(self):
+        with self.lock:
+            self.cache.save()
+
+    def shutdown(self, cancel: bool = False):
+        self.executor.shutdown(wait=True, cancel_futures=cancel)
+
+
+class BandMosaic:
+    # Generated by worker processes, a few bands of rows each, straight into one shared buffer
+    def __init__(self, pool: BandPool, src_path: str, dst_path: str, args: Arguments):
+        self.pool = pool
+        self.dst_path = dst_path
+        self.__unpack_args(args)
+
+        self.src = read_src(src_path, self.src_max_size, self.density)
+        self.src_height, self.src_width, _ = self.src.shape
+        self.block_rows = self.src_height // self.density
+        self.total = self.block_rows * (self.src_width // self.density)
+        self.dst_shape = (self.block_rows * self.pixel_size, self.src_width // self.density * self.pixel_size, 3)
+        self.futures = list[Future]()
+
+    def __unpack_args(self, args: Arguments):
+        self.density = args.density
+        self.src_max_size = args.src_size
+        self.pixel_size = args.pixel_size
+
+    def run(self, on_done: Callable[[int], None]):
+        # Several bands per worker, so that workers that finish early can take over the rest
+        band_rows = max(1, math.ceil(self.block_rows / (self.pool.workers * BANDS_PER_WORKER)))
+        shm = SharedMemory(create=True, size=math.prod(self.dst_shape))
+        try:
+            for band_start in range(0, self.block_rows, band_rows):
+                src_band = self.src[band_start * self.density:(band_start + band_rows) * self.density]
+                future = self.pool.executor.submit(generate_band, shm.name, self.dst_shape, band_start, src_band, self.pixel_size)
                 self.futures.append(future)
+            for future in as_completed(self.futures):
+                block_count, entries, tile_counts, band_metrics = future.result()
+                self.pool.add_results(entries, tile_counts, band_metrics)
+                on_done(block_count)
+
+            dst = numpy.ndarray(self.dst_shape, dtype=numpy.uint8, buffer=shm.buf)
+            with metrics.timer("generate.write"):
+                written = cv2.imwrite(self.dst_path, dst)
+            del dst
+            if not written:
+                raise OSError(f"{self.dst_path} could not be written")
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def cancel(self):
+        for future in self.futures:
+            future.cancel()
+
+
+class Generate(Action):
+    def __init__(self, args: Arguments):
+        self.args = args
+        self.__unpack_args(args)
+        # Worker processes load their own resources
+        self.resources = BandPool(args) if self.processes else Resources(args)
+
+        # The total grows as the source of every mosaic is loaded
+        self.progress = Progress(0)
+        self.progress_lock = Lock()
+        self.stats = Statistics()
+
+        self.executor = ThreadPoolExecutor(max_workers=self.parallel_jobs)
+        self.futures = list[Future]()
+        self.mosaics = set[Mosaic | VideoMosaic | BandMosaic]()
+        self.mosaics_lock = Lock()
+
+    def __unpack_args(self, args: Arguments):
+        self.jobs = args.jobs
+        self.parallel_jobs = args.parallel_jobs
+        self.video = args.video
+        self.processes = args.processes
+
+    def run(self):
+        self.progress.report()
+        self.start_time = perf_counter()
+
+        for src_path, dst_path in self.jobs:
+            future = self.executor.submit(self.__generate, src_path, dst_path)
+            self.futures.append(future)
         for future in as_completed(self.futures):
-            end_time = perf_counter()
-            self.stats.completion_time += end_time - start_time
-            start_time = end_time
-            self.progress.increment()
-            print(self.progress, end="\r")
+            future.result()
+            self.stats.mosaics += 1
 
-        print(self.progress)
+        self.__update_stats()
+        self.progress.finish()
         print(self.stats)
 
-        self.cache.save()
-        cv2.imwrite(self.dst_path, self.dst)
-    
-    def __fill_pixel(self, x: int, y: int):
-        src_colors = []
-        for y_offset in range(self.density):
-            for x_offset in range(self.density):
-                src_color = self.src[y+y_offset, x+x_offset]
-                src_colors.append(clamp_color(src_color, self.complexity))
-
-        img_key = colors_to_key(src_colors)
-        img_list = self.palette.get(img_key, [])
-
-        if not img_list:
-            cached_key = self.cache.get(img_key, None)
-
-            if cached_key:
-                # Cached key should be valid, unless you've reset the palette w/o resetting the cache
-                img_list = self.palette.get(cached_key, [])
-            else:
-                # TODO: do not use palette's data dict directly here
-                closest_key = colors_to_closest_key(self.palette.data, src_colors)
-                # Closest key should be valid, since it's found via the palette
-                img_list = self.palette.get(closest_key, [])
-                with self.cache_lock:
-                    self.cache.set(img_key, closest_key)
-                with self.stats_lock:
-                    self.stats.cached_entries += 1
-
-        img = cv2.imread(random.choice(img_list))
-        img = cv2.resize(img, (self.pixel_size, self.pixel_size))
-
-        # Apply palette image to dest
-        dest_y = int(y / self.density) * self.pixel_size
-        dest_x = int(x / self.density) * self.pixel_size
-        dest_y_end = dest_y + self.pixel_size
-        dest_x_end = dest_x + self.pixel_size
-        self.dst[dest_y:dest_y_end, dest_x:dest_x_end] = img[0:self.pixel_size, 0:self.pixel_size]
+        self.resources.save()
+        if self.processes:
+            self.resources.shutdown()
+
+    def __generate(self, src_path: str, dst_path: str):
+        if dst_dir := os_path.dirname(dst_path):
+            makedirs(dst_dir, exist_ok=True)
+        mosaic_type = VideoMosaic if self.video else BandMosaic if self.processes else Mosaic
+        mosaic = mosaic_type(self.resources, src_path, dst_path, self.args)
+        with self.mosaics_lock:
+            self.mosaics.add(mosaic)
+        with self.progress_lock:
+            self.progress.total += mosaic.total
+
+        try:
+            mosaic.run(self.__on_done)
+        finally:
+            with self.mosaics_lock:
+                self.mosaics.discard(mosaic)
+            if self.video:
+                with self.progress_lock:
+                    self.stats.reused_blocks += mosaic.reused_blocks
+
+    def __on_done(self, amount: int = 1):
+        with self.progress_lock:
+            end_time = perf_counter()
+            self.stats.completion_time += end_time - self.start_time
+            self.start_time = end_time
+            self.progress.increment(amount)
+            self.progress.report()
+
+    def __update_stats(self):
+        self.stats.cached_entries = self.resources.cached_entries
+        if self.processes:
+            self.stats.tile_hits = self.resources.tile_hits
+            self.stats.tile_misses = self.resources.tile_misses
+            self.stats.atlas_hits = self.resources.atlas_hits
+        else:
+            self.stats.tile_hits = self.resources.tiles.hits
+            self.stats.tile_misses = self.resources.tiles.misses
+            self.stats.atlas_hits = self.resources.tiles.atlas_hits
 
     def cancel(self):
-        print(f"\r{self.progress}")
+        self.__update_stats()
+        self.progress.finish()
         print(self.stats)
-        self.executor.shutdown(wait=True, cancel_futures=True)
-        self.cache.save()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        with self.mosaics_lock:
+            for mosaic in self.mosaics:
+                mosaic.cancel()
+        self.executor.shutdown(wait=True)
+        if self.processes:
+            self.resources.shutdown(cancel=True)
+        self.resources.save()
@@ -0,0 +1,261 @@
+import cv2
+import json
+import mimetypes
+import numpy
+import secrets
+import signal
+from argparse import ArgumentTypeError
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from hmac import compare_digest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import O_CREAT, O_TRUNC, O_WRONLY, chmod, fdopen, makedirs, open as os_open, path as os_path, remove
+from platformdirs import user_runtime_path
+from socketserver import ThreadingMixIn, UnixStreamServer
+from threading import Lock
+from time import perf_counter
+from urllib.parse import parse_qs, urlparse
+
+from arguments.parsers import Arguments
+from arguments.types import VALID_IMAGE_EXTS, existing_image, image, positive_int
+from utils.metrics import metrics
+from .base import Action
+from .generation import Mosaic, Resources
+
+# Largest image accepted in a request body
+MAX_REQUEST_BYTES = 256 * 1024 * 1024
+
+
+class Statistics:
+    def __init__(self):
+        self.completion_time = 0
+        self.served_requests = 0
+        self.failed_requests = 0
+
+    def __repr__(self) -> str:
+        return f"Completion time: {self.completion_time:.1f} sec\n" + \
+            f"Served requests: {self.served_requests}\n" + \
+            f"Failed requests: {self.failed_requests}"
+
+    def to_dict(self) -> dict:
+        return {
+            "completion_time": self.completion_time,
+            "served_requests": self.served_requests,
+            "failed_requests": self.failed_requests,
+        }
+
+
+class RequestError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    # Set on a subclass for every server, since handlers are created per request
+    serve: "Serve" = None
+
+    def address_string(self) -> str:
+        # Unix domain sockets have no client address
+        return "local"
+
+    def log_message(self, format: str, *args):
+        pass
+
+    def __authorized(self) -> bool:
+        # Any user of the machine can reach a port, unlike a socket, so requests to it need the token
+        if self.serve.token is None:
+            return True
+        if compare_digest(self.headers.get("Authorization", ""), f"Bearer {self.serve.token}"):
+            return True
+        self.__send_json(401, {"error": "missing or wrong token"})
+        return False
+
+    def do_GET(self):
+        if not self.__authorized():
+            return
+        url = urlparse(self.path)
+        if url.path == "/stats":
+            self.__send_json(200, self.serve.stats_dict())
+        else:
+            self.__send_json(404, {"error": f"{url.path} not found"})
+
+    def do_POST(self):
+        if not self.__authorized():
+            return
+        url = urlparse(self.path)
+        if url.path != "/generate":
+            self.__send_json(404, {"error": f"{url.path} not found"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            if length > MAX_REQUEST_BYTES:
+                raise RequestError(413, f"request is larger than {MAX_REQUEST_BYTES} bytes")
+            body = self.rfile.read(length)
+
+            if self.headers.get_content_type() == "application/json":
+                self.__send_json(200, self.serve.generate_paths(body))
+            else:
+                options = {key: vals[-1] for key, vals in parse_qs(url.query).items()}
+                ext, data = self.serve.generate_bytes(body, options)
+                content_type = mimetypes.guess_type(f"mosaic.{ext}")[0] or "application/octet-stream"
+                self.__send(200, content_type, data)
+        except RequestError as error:
+            self.__send_json(error.status, {"error": str(error)})
+        except Exception as error:
+            self.__send_json(500, {"error": str(error)})
+
+    def __send_json(self, status: int, data: dict):
+        self.__send(status, "application/json", json.dumps(data).encode("utf-8"))
+
+    def __send(self, status: int, content_type: str, data: bytes):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class Serve(Action):
+    def __init__(self, args: Arguments):
+        self.args = args
+        self.__unpack_args(args)
+
+        profile = f"{self.density} {self.complexity}"
+        self.resources = Resources(args)
+        self.stats = Statistics()
+        self.stats_lock = Lock()
+        self.saved_entries = 0
+
+        # Requests are accepted on their own threads, but only generated by the pool
+        self.executor = ThreadPoolExecutor(max_workers=self.parallel_jobs)
+        handler = type("Handler", (RequestHandler,), {"serve": self})
+        runtime_path = user_runtime_path("img2mosaic", "Parslie")
+        self.token = None
+        if self.port is not None:
+            self.server = ThreadingHTTPServer(("127.0.0.1", self.port), handler)
+            self.token = secrets.token_urlsafe(32)
+            self.token_path = str(runtime_path.joinpath(f"serve.{profile}.{self.port}.token"))
+            self.__write_token()
+            print(f"Listening on: http://127.0.0.1:{self.port}")
+            print(f"Token path: {self.token_path}")
+        else:
+            self.socket_path = self.socket or str(runtime_path.joinpath(f"serve.{profile}.sock"))
+            makedirs(os_path.dirname(self.socket_path) or ".", exist_ok=True)
+            self.__remove_socket()
+            self.server = UnixHTTPServer(self.socket_path, handler)
+            # Only the user may connect, since requests read and write their files
+            chmod(self.socket_path, 0o600)
+            print(f"Socket path: {self.socket_path}")
+
+    def __unpack_args(self, args: Arguments):
+        self.density = args.density
+        self.complexity = args.complexity
+        self.socket = args.socket
+        self.port = args.port
+        self.parallel_jobs = args.parallel_jobs
+
+    def __write_token(self):
+        # Created readable by the user alone, so that only they can send requests
+        makedirs(os_path.dirname(self.token_path), exist_ok=True)
+        if os_path.exists(self.token_path):
+            remove(self.token_path)
+        with fdopen(os_open(self.token_path, O_CREAT | O_TRUNC | O_WRONLY, 0o600), "w") as file:
+            file.write(self.token)
+
+    def __remove_socket(self):
+        # Sockets are left behind by servers that were killed
+        if os_path.exists(self.socket_path):
+            remove(self.socket_path)
+
+    def run(self):
+        # Stopped by service managers the same way as by the keyboard
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        self.server.serve_forever()
+
+    def stats_dict(self) -> dict:
+        with self.stats_lock:
+            return self.stats.to_dict() | {
+                "cached_entries": self.resources.cached_entries,
+                "tile_hits": self.resources.tiles.hits,
+                "tile_misses": self.resources.tiles.misses,
+                "atlas_hits": self.resources.tiles.atlas_hits,
+            }
+
+    def generate_paths(self, body: bytes) -> dict:
+        try:
+            request = json.loads(body)
+            src_path = existing_image(str(request["src"]))
+            dst_path = image(str(request["dst"]))
+        except (ValueError, KeyError, TypeError, ArgumentTypeError) as error:
+            raise RequestError(400, f"invalid request: {error}")
+
+        args = self.__request_args(request)
+        start_time = perf_counter()
+        if dst_dir := os_path.dirname(dst_path):
+            makedirs(dst_dir, exist_ok=True)
+        self.executor.submit(self.__run_mosaic, src_path, dst_path, args).result()
+        return {"dst": dst_path, "seconds": perf_counter() - start_time}
+
+    def generate_bytes(self, body: bytes, options: dict) -> tuple[str, bytes]:
+        ext = options.get("format", "png").lower()
+        if ext not in VALID_IMAGE_EXTS:
+            raise RequestError(400, f"{ext} is not an image format")
+        src = cv2.imdecode(numpy.frombuffer(body, dtype=numpy.uint8), cv2.IMREAD_COLOR)
+        if src is None:
+            raise RequestError(400, "body is not an image")
+
+        args = self.__request_args(options)
+        dst = self.executor.submit(self.__run_mosaic, src, None, args).result()
+        encoded, data = cv2.imencode(f".{ext}", dst)
+        if not encoded:
+            raise RequestError(500, f"mosaic could not be encoded as {ext}")
+        return ext, data.tobytes()
+
+    def __request_args(self, options: dict) -> Arguments:
+        # Only the sizes may differ between requests, the rest is fixed by the loaded resources
+        try:
+            src_size = positive_int(str(options.get("src_size", self.args.src_size)))
+            pixel_size = positive_int(str(options.get("pixel_size", self.args.pixel_size)))
+        except ArgumentTypeError as error:
+            raise RequestError(400, f"invalid request: {error}")
+        return replace(self.args, src_size=src_size, pixel_size=pixel_size, stream=False)
+
+    def __run_mosaic(self, src: str | numpy.ndarray, dst_path: str | None, args: Arguments) -> numpy.ndarray:
+        start_time = perf_counter()
+        try:
+            with metrics.timer("serve.request"):
+                dst = Mosaic(self.resources, src, dst_path, args).run(lambda: None)
+        except Exception:
+            with self.stats_lock:
+                self.stats.failed_requests += 1
+            raise
+
+        with self.stats_lock:
+            self.stats.served_requests += 1
+            self.stats.completion_time += perf_counter() - start_time
+        self.__save()
+        return dst
+
+    def __save(self):
+        # Entries found for one request are kept, even if the server is killed later
+        with self.stats_lock:
+            if self.resources.cached_entries == self.saved_entries:
+                return
+            self.saved_entries = self.resources.cached_entries
+        self.resources.save()
+
+    def cancel(self):
+        print(self.stats)
+        self.server.server_close()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.resources.save()
+        if self.port is None:
+            self.__remove_socket()
+        elif os_path.exists(self.token_path):
+            remove(self.token_path)
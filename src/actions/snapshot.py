@@ -0,0 +1,63 @@
+from time import perf_counter
+
+from arguments.parsers import Arguments
+from data.cache import Cache
+from data.palette import CompactPalette, Palette
+from data.snapshot import Snapshot as SnapshotData
+from utils.colors import KeyCodec
+from utils.matching import Matcher
+from .base import Action
+
+
+class Statistics:
+    def __init__(self):
+        self.completion_time = 0
+        self.palette_keys = 0
+        self.cache_entries = 0
+        self.snapshot_size = 0
+
+    def __repr__(self) -> str:
+        return f"Completion time: {self.completion_time:.1f} sec\n" + \
+            f"Palette keys: {self.palette_keys}\n" + \
+            f"Cache entries: {self.cache_entries}\n" + \
+            f"Snapshot size: {self.snapshot_size / 1024 / 1024:.1f} MiB"
+
+
+class Snapshot(Action):
+    def __init__(self, args: Arguments):
+        self.__unpack_args(args)
+
+        profile = f"{self.density} {self.complexity}"
+        self.codec = KeyCodec(self.density * self.density * 3, self.complexity)
+        self.cache = Cache(profile, self.storage_type)
+        self.palette = Palette(profile, self.storage_type)
+        self.snapshot = SnapshotData(profile, self.codec)
+        self.stats = Statistics()
+
+    def __unpack_args(self, args: Arguments):
+        self.density = args.density
+        self.complexity = args.complexity
+        self.storage_type = args.storage
+
+    def run(self):
+        start_time = perf_counter()
+
+        # Read first, so that a palette changed while snapshotting leaves the snapshot out of date
+        version = self.palette.storage.version()
+        palette = self.palette.compact(self.codec)
+        keys, tree = self.palette.index()
+        # Storage is read in sorted order, but indices of the palette, matcher and index have to be the same regardless
+        if keys != palette.keys:
+            palette = CompactPalette.from_items(sorted(self.palette.storage.items()), self.codec)
+        cache = self.cache.compact(self.codec, palette)
+        matcher = Matcher(keys)
+        self.snapshot.write(palette, cache, matcher, tree, self.palette.path, version)
+
+        self.stats.completion_time = perf_counter() - start_time
+        self.stats.palette_keys = len(palette)
+        self.stats.cache_entries = len(cache)
+        self.stats.snapshot_size = self.snapshot.size()
+        print(self.stats)
+
+    def cancel(self):
+        print(self.stats)
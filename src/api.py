@@ -0,0 +1,98 @@
+import cv2
+import numpy
+from contextlib import redirect_stdout
+from dataclasses import replace
+from io import StringIO
+
+from actions.analysis import add_img, img_to_key, refresh_cache
+from actions.generation import Mosaic, Resources
+from arguments.parsers import Arguments
+from data.cache import Cache
+from data.manifest import Manifest
+from data.palette import Palette
+from utils.files import file_fingerprint
+
+# Options that may differ between mosaics generated with the same resources
+MOSAIC_OPTIONS = ("src_size", "pixel_size", "fetch_workers", "blit_workers")
+
+
+def decode_img(src: numpy.ndarray | bytes) -> numpy.ndarray:
+    if isinstance(src, numpy.ndarray):
+        return src
+
+    img = cv2.imdecode(numpy.frombuffer(src, dtype=numpy.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("bytes are not an image")
+    return img
+
+
+def encode_img(img: numpy.ndarray, format: str = "png") -> bytes:
+    encoded, data = cv2.imencode(f".{format}", img)
+    if not encoded:
+        raise ValueError(f"image could not be encoded as {format}")
+    return data.tobytes()
+
+
+class MosaicGenerator:
+    # Loads the palette, cache and matcher once, for any amount of mosaics
+    def __init__(self, density: int = Arguments.density, **options):
+        self.args = Arguments(action="generate", density=density, **options)
+        with redirect_stdout(StringIO()):
+            self.resources = Resources(self.args)
+
+    def generate(self, src: numpy.ndarray | bytes, **options) -> numpy.ndarray:
+        invalid_options = set(options) - set(MOSAIC_OPTIONS)
+        if invalid_options:
+            raise TypeError(f"options can't differ between mosaics: {", ".join(sorted(invalid_options))}")
+
+        args = replace(self.args, stream=False, **options)
+        return Mosaic(self.resources, decode_img(src), None, args).run(lambda: None)
+
+    def generate_encoded(self, src: numpy.ndarray | bytes, format: str = "png", **options) -> bytes:
+        return encode_img(self.generate(src, **options), format)
+
+    def save(self):
+        # Colors matched while generating are only cached for later runs once saved
+        self.resources.save()
+
+    def __enter__(self) -> "MosaicGenerator":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.save()
+
+
+class Analyzer:
+    def __init__(self, density: int = Arguments.density, storage: str = Arguments.storage):
+        self.density = density
+        self.complexity = Arguments.complexity
+
+        profile = f"{self.density} {self.complexity}"
+        with redirect_stdout(StringIO()):
+            self.cache = Cache(profile, storage)
+            self.palette = Palette(profile, storage)
+            self.manifest = Manifest(profile, storage)
+        self.added_keys = set[str]()
+
+    def key(self, src: numpy.ndarray | bytes) -> str:
+        return img_to_key(decode_img(src), self.density, self.complexity)
+
+    def add(self, path: str, src: numpy.ndarray | bytes) -> str:
+        # The image is analyzed as given, but is still used as a pixel from its path
+        img_key = self.key(src)
+        if add_img(self.palette, self.cache, self.manifest, path, img_key, file_fingerprint(path), None):
+            self.added_keys.add(img_key)
+        return img_key
+
+    def save(self):
+        refresh_cache(self.palette, self.cache, self.added_keys)
+        self.added_keys.clear()
+        self.cache.save()
+        self.palette.save()
+        self.manifest.save()
+
+    def __enter__(self) -> "Analyzer":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.save()
@@ -1,7 +1,11 @@
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 from dataclasses import dataclass
+from glob import glob, has_magic
+from os import path
 
-from .types import existing_image, image, existing_folder, positive_int
+from data.storage import STORAGE_TYPES
+from utils.streaming import STREAMABLE_IMAGE_EXTS
+from .types import existing_image, image, existing_video, video, existing_folder, positive_int, non_negative_float, VALID_IMAGE_EXTS, VALID_VIDEO_EXTS
 
 
 @dataclass
@@ -9,16 +13,37 @@ class Arguments:
     action: str = ""
     density: int = 1
     complexity: int = 9 # TODO: add as settable later
+    approx: float = 0.0
+    storage: str = STORAGE_TYPES[0]
+    metrics: str = ""
+    metrics_interval: float = 0.0
 
-    src: str = ""
-    dst: str = ""
+    paths: list[str] = None
+    manifest: str = ""
+    jobs: list[tuple[str, str]] = None
+    parallel_jobs: int = 2
     src_size: int = 64
     pixel_size: int = 32
+    tile_cache_size: int = 256
+    stream: bool = False
+    video: bool = False
+    fetch_workers: int = 6
+    blit_workers: int = 2
 
     dir: str = ""
     recursive: bool = False
+    processes: bool = False
+    workers: int = None
+    digest: bool = False
 
     all: bool = False
+    dense: bool = False
+    prewarm: str = None
+
+    pixel_sizes: list[int] = None
+
+    socket: str = ""
+    port: int = None
 
 
 def add_general_arguments(parser: ArgumentParser):
@@ -29,19 +54,87 @@ def add_general_arguments(parser: ArgumentParser):
         help="amount of pixels to be represented by one image",
         metavar="PIXELS",
     )
+    parser.add_argument(
+        "--storage",
+        choices=STORAGE_TYPES,
+        default=Arguments.storage,
+        help="format of the stored palette and cache, existing JSON files are migrated to SQLite",
+    )
+    parser.add_argument(
+        "--metrics",
+        default=Arguments.metrics,
+        help="path to write the time spent per stage to once done, in the Prometheus text format for .prom files and as JSON otherwise",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=non_negative_float,
+        default=Arguments.metrics_interval,
+        help="seconds between writes of the metrics while running, where 0 only writes them once done",
+        metavar="SECONDS",
+    )
+
+
+def add_matching_arguments(parser: ArgumentParser):
+    parser.add_argument(
+        "--approx",
+        type=non_negative_float,
+        default=Arguments.approx,
+        help="allowed relative error of color matches, trading accuracy for speed where palettes are searched by index",
+        metavar="EPSILON",
+    )
 
 
 def add_generation_arguments(parser: ArgumentParser):
     parser.add_argument(
-        "src",
-        type=existing_image,
-        help="path to the image to mosaic",
+        "paths",
+        nargs="*",
+        help="paths or globs of the images to mosaic, followed by the path to the generated mosaic, "
+            "or to the directory of generated mosaics when there are several",
+        metavar="SRC... DST",
+    )
+    parser.add_argument(
+        "--manifest",
+        default=Arguments.manifest,
+        help="path to a file of tab separated source and generated mosaic paths, one pair per line",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        dest="parallel_jobs",
+        type=positive_int,
+        default=Arguments.parallel_jobs,
+        help="amount of mosaics generated in parallel",
+        metavar="COUNT",
+    )
+    parser.add_argument(
+        "--processes",
+        default=False,
+        action="store_true",
+        help="generate bands of rows of every mosaic in separate processes, which each load the palette and cache once",
+    )
+    parser.add_argument(
+        "-w", "--workers",
+        type=positive_int,
+        default=Arguments.workers,
+        help="amount of processes generating bands, defaults to the CPU count",
+        metavar="COUNT",
+    )
+    parser.add_argument(
+        "--stream",
+        default=False,
+        action="store_true",
+        help=f"write the mosaic in bands instead of all at once, only for {", ".join(STREAMABLE_IMAGE_EXTS)} files",
     )
     parser.add_argument(
-        "dst",
-        type=image,
-        help="path to the generated mosaic",
+        "--video",
+        default=False,
+        action="store_true",
+        help=f"generate mosaic videos of videos or frame sequences, such as frames/%%04d.png, only for {", ".join(VALID_VIDEO_EXTS)} files",
     )
+
+
+def add_mosaic_arguments(parser: ArgumentParser):
     parser.add_argument(
         "-s",
         dest="src_size",
@@ -58,6 +151,52 @@ def add_generation_arguments(parser: ArgumentParser):
         help="size of the images used as pixels",
         metavar="PIXELS",
     )
+    parser.add_argument(
+        "--tile-cache",
+        dest="tile_cache_size",
+        type=positive_int,
+        default=Arguments.tile_cache_size,
+        help="memory budget for decoded images used as pixels",
+        metavar="MB",
+    )
+    parser.add_argument(
+        "--fetch-workers",
+        type=positive_int,
+        default=Arguments.fetch_workers,
+        help="amount of threads loading images used as pixels",
+        metavar="COUNT",
+    )
+    parser.add_argument(
+        "--blit-workers",
+        type=positive_int,
+        default=Arguments.blit_workers,
+        help="amount of threads copying images used as pixels into the mosaic",
+        metavar="COUNT",
+    )
+
+
+def add_serve_arguments(parser: ArgumentParser):
+    parser.add_argument(
+        "--socket",
+        default=Arguments.socket,
+        help="path to the Unix domain socket to listen on, defaults to one in the user's runtime directory",
+        metavar="PATH",
+    )
+    parser.add_argument(
+        "--port",
+        type=positive_int,
+        default=Arguments.port,
+        help="local port to listen on instead of a socket, where requests need the token written to the user's runtime directory",
+        metavar="PORT",
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        dest="parallel_jobs",
+        type=positive_int,
+        default=Arguments.parallel_jobs,
+        help="amount of mosaics generated in parallel",
+        metavar="COUNT",
+    )
 
 
 def add_analysis_arguments(parser: ArgumentParser):
@@ -73,6 +212,26 @@ def add_analysis_arguments(parser: ArgumentParser):
         action="store_true",
         help="recursively look through directory",
     )
+    parser.add_argument(
+        "--processes",
+        default=False,
+        action="store_true",
+        help="analyze images in separate processes instead of threads",
+    )
+    parser.add_argument(
+        "-w", "--workers",
+        type=positive_int,
+        default=Arguments.workers,
+        help="amount of images analyzed in parallel, defaults to the CPU count",
+        metavar="COUNT",
+    )
+    parser.add_argument(
+        "--hash",
+        dest="digest",
+        default=False,
+        action="store_true",
+        help="hash file contents, so that images which were only touched aren't analyzed again",
+    )
 
 
 def add_cache_arguments(parser: ArgumentParser):
@@ -82,6 +241,97 @@ def add_cache_arguments(parser: ArgumentParser):
         action="store_true",
         help="generate entries for all colors, even ones already cached",
     )
+    parser.add_argument(
+        "--dense",
+        default=False,
+        action="store_true",
+        help="compute a lookup table of every color at once, only for a density of 1",
+    )
+    parser.add_argument(
+        "--prewarm",
+        type=existing_folder,
+        default=Arguments.prewarm,
+        help="only generate entries for the colors of blocks in the typical source images of a directory, the most frequent first",
+        metavar="PATH",
+    )
+    parser.add_argument(
+        "-r", "--recursive",
+        default=False,
+        action="store_true",
+        help="recursively look through the directory to prewarm from",
+    )
+    parser.add_argument(
+        "-s",
+        dest="src_size",
+        type=positive_int,
+        default=Arguments.src_size,
+        help="size the images to prewarm from are scaled to, like when generating mosaics of them",
+        metavar="PIXELS",
+    )
+
+
+def add_atlas_arguments(parser: ArgumentParser):
+    parser.add_argument(
+        "-p",
+        dest="pixel_sizes",
+        type=positive_int,
+        nargs="+",
+        default=[Arguments.pixel_size],
+        help="sizes of the images used as pixels to pre-render",
+        metavar="PIXELS",
+    )
+
+
+def read_manifest(manifest_path: str, is_video: bool) -> list[tuple[str, str]]:
+    src_type, dst_type = (existing_video, video) if is_video else (existing_image, image)
+    jobs = []
+    with open(manifest_path, "r") as file:
+        for line_idx, line in enumerate(file, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+
+            fields = line.split("\t")
+            if len(fields) != 2:
+                raise ArgumentTypeError(f"line {line_idx} of {manifest_path} is not a tab separated pair of paths")
+            jobs.append((src_type(fields[0]), dst_type(fields[1])))
+    return jobs
+
+
+def expand_sources(values: list[str], is_video: bool) -> list[str]:
+    src_type, exts = (existing_video, VALID_VIDEO_EXTS) if is_video else (existing_image, VALID_IMAGE_EXTS)
+    srcs = []
+    for value in values:
+        if not has_magic(value):
+            srcs.append(src_type(value))
+            continue
+
+        matches = [match for match in sorted(glob(value, recursive=True)) if path.isfile(match)]
+        matches = [match for match in matches if path.splitext(match)[1][1:].lower() in exts]
+        if not matches:
+            raise ArgumentTypeError(f"{value} does not match any {"videos" if is_video else "images"}")
+        srcs.extend(matches)
+    return srcs
+
+
+def get_generation_jobs(args: Arguments) -> list[tuple[str, str]]:
+    if args.manifest:
+        if args.paths:
+            raise ArgumentTypeError("paths can't be given together with a manifest")
+        return read_manifest(args.manifest, args.video)
+    if len(args.paths) < 2:
+        raise ArgumentTypeError("both a source and a destination are required")
+
+    *values, dst = args.paths
+    if len(values) == 1 and not has_magic(values[0]):
+        if args.video:
+            return [(existing_video(values[0]), video(dst))]
+        return [(existing_image(values[0]), image(dst))]
+
+    # Several mosaics are written to a directory, under the names of their sources
+    if path.exists(dst) and not path.isdir(dst):
+        raise ArgumentTypeError(f"{dst} is not a directory")
+    return [(src, path.join(dst, path.basename(src))) for src in expand_sources(values, args.video)]
 
 
 def create_parser() -> ArgumentParser:
@@ -97,10 +347,12 @@ def create_parser() -> ArgumentParser:
 
     generate_parser = sub_parsers.add_parser(
         "generate",
-        description="Generates a mosaic of an image, with images that have been analyzed.",
-        help="generate a mosaic of an image",
+        description="Generates mosaics of images, with images that have been analyzed.",
+        help="generate mosaics of images",
     )
     add_generation_arguments(generate_parser)
+    add_mosaic_arguments(generate_parser)
+    add_matching_arguments(generate_parser)
     add_general_arguments(generate_parser)
 
     analyze_parser = sub_parsers.add_parser(
@@ -117,8 +369,34 @@ def create_parser() -> ArgumentParser:
         help="associate colors with close analyzed colors",
     )
     add_cache_arguments(cache_parser)
+    add_matching_arguments(cache_parser)
     add_general_arguments(cache_parser)
 
+    atlas_parser = sub_parsers.add_parser(
+        "atlas",
+        description="Pre-renders analyzed images at the sizes used as pixels, so that generation can skip decoding them.",
+        help="pre-render analyzed images for generation",
+    )
+    add_atlas_arguments(atlas_parser)
+    add_general_arguments(atlas_parser)
+
+    serve_parser = sub_parsers.add_parser(
+        "serve",
+        description="Keeps the palette, cache and images used as pixels loaded, and generates mosaics requested over HTTP on a local socket.",
+        help="generate mosaics requested over a local socket",
+    )
+    add_serve_arguments(serve_parser)
+    add_mosaic_arguments(serve_parser)
+    add_matching_arguments(serve_parser)
+    add_general_arguments(serve_parser)
+
+    snapshot_parser = sub_parsers.add_parser(
+        "snapshot",
+        description="Saves the palette, cache and index as arrays that generation maps from disk, so that processes share them instead of each loading their own.",
+        help="save the palette, cache and index for generation to map",
+    )
+    add_general_arguments(snapshot_parser)
+
     return parser
 
 
@@ -126,4 +404,28 @@ def get_args() -> Arguments:
     parser = create_parser()
     args = Arguments()
     parser.parse_args(namespace=args)
+
+    if args.action == "cache" and args.dense and args.density != 1:
+        parser.error("argument --dense: only supported with a density of 1")
+    if args.action == "cache" and args.dense and args.prewarm:
+        parser.error("argument --prewarm: not allowed with argument --dense")
+    if args.action == "serve" and args.socket and args.port is not None:
+        parser.error("argument --port: not allowed with argument --socket")
+    if args.action == "generate":
+        try:
+            args.jobs = get_generation_jobs(args)
+        except (ArgumentTypeError, OSError) as error:
+            parser.error(str(error))
+        dst_paths = [path.normpath(dst) for _, dst in args.jobs]
+        if len(set(dst_paths)) != len(dst_paths):
+            parser.error("several mosaics would be generated at the same path")
+    if args.action == "generate" and args.stream and args.video:
+        parser.error("argument --stream: not supported for videos")
+    if args.action == "generate" and args.processes and args.video:
+        parser.error("argument --processes: not supported for videos")
+    if args.action == "generate" and args.processes and args.stream:
+        parser.error("argument --processes: not allowed with argument --stream")
+    if args.action == "generate" and args.stream:
+        if any(path.splitext(dst)[1][1:].lower() not in STREAMABLE_IMAGE_EXTS for _, dst in args.jobs):
+            parser.error(f"argument --stream: only supported for {", ".join(STREAMABLE_IMAGE_EXTS)} files")
     return args
@@ -1,6 +1,8 @@
 from argparse import ArgumentTypeError
 from os import path
 
+from utils.video import VIDEO_FOURCCS, is_frame_sequence
+
 # Taken from OpenCV documentation
 # NOTE: may restrict
 VALID_IMAGE_EXTS = (
@@ -17,6 +19,7 @@ VALID_IMAGE_EXTS = (
     "exr",
     "hdr", "pic",
 )
+VALID_VIDEO_EXTS = tuple(VIDEO_FOURCCS)
 
 
 def image(value: str) -> str:
@@ -34,6 +37,28 @@ def existing_image(value: str) -> str:
     return image(value)
 
 
+def video(value: str) -> str:
+    if is_frame_sequence(value):
+        return image(value)
+
+    ext = path.splitext(value)[1][1:]
+    if ext.lower() not in VALID_VIDEO_EXTS:
+        raise ArgumentTypeError(f"{value} is not a video")
+    return value
+
+
+def existing_video(value: str) -> str:
+    # Frames of a sequence are only looked up once it is opened
+    if is_frame_sequence(value):
+        return image(value)
+
+    if not path.exists(value):
+        raise ArgumentTypeError(f"{value} does not exist")
+    elif not path.isfile(value):
+        raise ArgumentTypeError(f"{value} is not a file")
+    return video(value)
+
+
 def existing_folder(value: str) -> str:
     if not path.exists(value):
         raise ArgumentTypeError(f"{value} does not exist")
@@ -50,3 +75,14 @@ def positive_int(value: str) -> int:
     if value <= 0:
         raise ArgumentTypeError(f"{value} is not a positive integer")
     return value
+
+
+def non_negative_float(value: str) -> float:
+    try:
+        value: float = float(value)
+    except ValueError:
+        raise ArgumentTypeError(f"{value} is not a number")
+
+    if value < 0:
+        raise ArgumentTypeError(f"{value} is not a non-negative number")
+    return value
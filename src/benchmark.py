@@ -0,0 +1,263 @@
+import cv2
+import json
+import numpy
+import os
+import platform
+import sys
+from argparse import ArgumentParser
+from contextlib import contextmanager, redirect_stdout
+from datetime import datetime, timezone
+from io import StringIO
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Callable, Iterator
+
+from actions.analysis import Analyze
+from actions.cache import Cache as CacheAction
+from actions.generation import Generate
+from arguments.parsers import Arguments
+from arguments.types import positive_int
+from data.cache import Cache
+from data.palette import Palette
+from data.storage import DATA_DIR_ENV, STORAGE_TYPES
+from utils.colors import colors_to_closest_key, colors_to_key, key_to_colors, keys_to_vectors, vector_to_key
+from utils.matching import Matcher
+
+# Images of the synthetic library are small, since only their average colors matter to the palette
+LIBRARY_IMG_SIZE = 64
+SRC_IMG_SHAPE = (768, 1024)
+PIXEL_SIZE = 16
+MICRO_QUERY_COUNT = 64
+MICRO_KEY_COUNT = 10_000
+
+
+def best_of(func: Callable[[], None], repeat: int) -> float:
+    best_time = float("inf")
+    for _ in range(repeat):
+        start_time = perf_counter()
+        func()
+        best_time = min(best_time, perf_counter() - start_time)
+    return best_time
+
+
+def quietly(func: Callable[[], None]) -> Callable[[], None]:
+    # Actions report their progress on stdout, which would drown out the results
+    def run():
+        with redirect_stdout(StringIO()):
+            func()
+    return run
+
+
+@contextmanager
+def data_dir(path: str) -> Iterator[None]:
+    # Kept in a temporary directory, so that the user's palette and cache are never touched
+    prev_path = os.environ.get(DATA_DIR_ENV)
+    os.environ[DATA_DIR_ENV] = path
+    try:
+        yield
+    finally:
+        if prev_path is None:
+            os.environ.pop(DATA_DIR_ENV, None)
+        else:
+            os.environ[DATA_DIR_ENV] = prev_path
+
+
+def describe(name: str, params: dict) -> str:
+    return " ".join([name] + [f"{key}={val}" for key, val in params.items()])
+
+
+def make_library(dir: str, count: int, rng: numpy.random.Generator):
+    # Noisy solid colors, as both JPEGs and PNGs, so that every decode path is covered
+    base_colors = rng.integers(0, 256, (count, 3))
+    for idx, base_color in enumerate(base_colors):
+        noise = rng.integers(-24, 25, (LIBRARY_IMG_SIZE, LIBRARY_IMG_SIZE, 3))
+        img = numpy.clip(base_color + noise, 0, 255).astype(numpy.uint8)
+        ext = "jpg" if idx % 2 else "png"
+        cv2.imwrite(os.path.join(dir, f"img{idx}.{ext}"), img)
+
+
+def make_src(path: str, rng: numpy.random.Generator):
+    # Smooth gradients, like photos, so that neighboring blocks often share colors
+    coarse = rng.integers(0, 256, (12, 16, 3)).astype(numpy.uint8)
+    height, width = SRC_IMG_SHAPE
+    cv2.imwrite(path, cv2.resize(coarse, (width, height), interpolation=cv2.INTER_CUBIC))
+
+
+def bench_actions(palette_size: int, density: int, src_sizes: list[int], rng: numpy.random.Generator) -> list[dict]:
+    results = []
+    with TemporaryDirectory() as tmp_dir, data_dir(os.path.join(tmp_dir, "data")):
+        library_dir = os.path.join(tmp_dir, "library")
+        os.makedirs(library_dir)
+        make_library(library_dir, palette_size, rng)
+        src_path = os.path.join(tmp_dir, "src.png")
+        make_src(src_path, rng)
+
+        def record(action: str, seconds: float, **params):
+            results.append({"action": action, "palette_size": palette_size, "density": density, **params, "seconds": seconds})
+            print(f"{describe(action, {"palette_size": palette_size, "density": density} | params)}: {seconds:.3f} sec")
+
+        args = Arguments(action="analyze", density=density, dir=library_dir)
+        record("analyze", best_of(quietly(lambda: Analyze(args).run()), 1))
+
+        # Every color can only be enumerated for a density of 1
+        if density == 1:
+            args = Arguments(action="cache", density=density, all=True)
+            record("cache", best_of(quietly(lambda: CacheAction(args).run()), 1))
+            args = Arguments(action="cache", density=density, dense=True)
+            record("cache", best_of(quietly(lambda: CacheAction(args).run()), 1), dense=True)
+
+        for src_size in src_sizes:
+            dst_path = os.path.join(tmp_dir, f"dst.{src_size}.png")
+            args = Arguments(action="generate", density=density, src_size=src_size, pixel_size=PIXEL_SIZE, jobs=[(src_path, dst_path)])
+            # The first run fills the cache and the tile files' page cache, later runs are warm
+            record("generate", best_of(quietly(lambda: Generate(args).run()), 1), src_size=src_size, warm=False)
+            record("generate", best_of(quietly(lambda: Generate(args).run()), 2), src_size=src_size, warm=True)
+
+    return results
+
+
+def bench_colors(palette_sizes: list[int], repeat: int, rng: numpy.random.Generator) -> list[dict]:
+    results = []
+
+    def record(name: str, seconds: float, count: int, **params):
+        results.append({"name": name, **params, "count": count, "seconds": seconds, "seconds_per_item": seconds / count})
+        print(f"{describe(name, params)}: {seconds / count * 1e6:.2f} usec")
+
+    vectors = rng.integers(0, 256, (MICRO_KEY_COUNT, 3), dtype=numpy.uint8)
+    keys = [vector_to_key(vector) for vector in vectors]
+    colors = [[vector] for vector in vectors]
+    record("colors_to_key", best_of(lambda: [colors_to_key(color) for color in colors], repeat), len(colors))
+    record("key_to_colors", best_of(lambda: [key_to_colors(key) for key in keys], repeat), len(keys))
+    record("vector_to_key", best_of(lambda: [vector_to_key(vector) for vector in vectors], repeat), len(vectors))
+    record("keys_to_vectors", best_of(lambda: keys_to_vectors(keys), repeat), len(keys))
+
+    queries = [[vector] for vector in rng.integers(0, 256, (MICRO_QUERY_COUNT, 3), dtype=numpy.uint8)]
+    query_vectors = numpy.concatenate([query[0][numpy.newaxis] for query in queries])
+    for palette_size in palette_sizes:
+        palette = {key: [] for key in keys[:palette_size]}
+        record("colors_to_closest_key", best_of(lambda: [colors_to_closest_key(palette, query) for query in queries], repeat), len(queries), palette_size=palette_size)
+        matcher = Matcher(list(palette))
+        record("matcher.closest_keys", best_of(lambda: matcher.closest_keys(query_vectors), repeat), len(queries), palette_size=palette_size)
+
+    return results
+
+
+def bench_storage(palette_sizes: list[int], repeat: int) -> list[dict]:
+    results = []
+
+    def record(name: str, seconds: float, **params):
+        results.append({"name": name, **params, "seconds": seconds})
+        print(f"{describe(name, params)}: {seconds:.3f} sec")
+
+    for storage_type in STORAGE_TYPES:
+        for palette_size in palette_sizes:
+            with TemporaryDirectory() as tmp_dir, data_dir(tmp_dir):
+                keys = [f"{idx % 256} {idx // 256 % 256} {idx // 65536}" for idx in range(palette_size)]
+
+                def save():
+                    palette = Palette("1 9", storage_type)
+                    cache = Cache("1 9", storage_type)
+                    for key in keys:
+                        palette.set(key, [os.path.join(tmp_dir, f"{key}.png")])
+                        cache.set(key, key)
+                    palette.save()
+                    cache.save()
+
+                def load():
+                    Palette("1 9", storage_type).data
+                    Cache("1 9", storage_type).data
+
+                record("palette_cache.save", best_of(quietly(save), repeat), storage=storage_type, entries=palette_size)
+                record("palette_cache.load", best_of(quietly(load), repeat), storage=storage_type, entries=palette_size)
+
+    return results
+
+
+def create_parser() -> ArgumentParser:
+    parser = ArgumentParser(
+        "img2mosaic-benchmark",
+        description="Times analysis, caching and generation on synthetic images, without touching the real palette.",
+        allow_abbrev=False,
+    )
+    parser.add_argument(
+        "-o", "--output",
+        default="benchmark.json",
+        help="path to write the results to, as JSON",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--palette-sizes",
+        type=positive_int,
+        nargs="+",
+        default=[100, 1000],
+        help="amounts of images in the synthetic libraries",
+        metavar="COUNT",
+    )
+    parser.add_argument(
+        "--densities",
+        type=positive_int,
+        nargs="+",
+        default=[1, 2],
+        help="densities to analyze and generate with",
+        metavar="PIXELS",
+    )
+    parser.add_argument(
+        "--src-sizes",
+        type=positive_int,
+        nargs="+",
+        default=[64, 256],
+        help="sizes of the images to mosaic",
+        metavar="PIXELS",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=positive_int,
+        default=3,
+        help="amount of times every micro-benchmark is run, of which the fastest is kept",
+        metavar="COUNT",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="seed of the synthetic images, so that runs can be compared",
+    )
+    parser.add_argument(
+        "--skip-actions",
+        default=False,
+        action="store_true",
+        help="only run the micro-benchmarks",
+    )
+    return parser
+
+
+def main():
+    args = create_parser().parse_args()
+    rng = numpy.random.default_rng(args.seed)
+
+    results = {
+        "meta": {
+            "time": datetime.now(timezone.utc).isoformat(),
+            "python": sys.version.split(" ")[0],
+            "numpy": numpy.__version__,
+            "opencv": cv2.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "seed": args.seed,
+        },
+        "actions": [],
+        "colors": bench_colors(args.palette_sizes, args.repeat, rng),
+        "storage": bench_storage(args.palette_sizes, args.repeat),
+    }
+    if not args.skip_actions:
+        for palette_size in args.palette_sizes:
+            for density in args.densities:
+                results["actions"] += bench_actions(palette_size, density, args.src_sizes, rng)
+
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Results path: {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+import json
+import numpy
+from os import makedirs, replace
+
+from utils.files import file_fingerprint
+from .storage import data_path
+
+
+class Atlas:
+    def __init__(self, profile: str, pixel_size: int):
+        dir_path = data_path()
+        self.path = dir_path.joinpath(f"atlas.{profile}.{pixel_size}.npy")
+        self.slots_path = dir_path.joinpath(f"atlas.{profile}.{pixel_size}.json")
+        self.tmp_path = self.path.with_suffix(".npy.tmp")
+        self.pixel_size = pixel_size
+        print(f"Atlas path: {self.path}")
+
+        self.tiles = None
+        self.slots = {}
+        self.fingerprints = {}
+        if self.path.exists() and self.slots_path.exists():
+            tiles = numpy.load(self.path, mmap_mode="r")
+            with self.slots_path.open("r") as file:
+                slots_data = json.loads(file.read())
+            # Both files are replaced separately, so a crash in between leaves them mismatched
+            if slots_data["count"] == len(tiles):
+                self.tiles = tiles
+                self.slots = slots_data["slots"]
+                # Atlases from before fingerprints were kept are rendered again
+                self.fingerprints = slots_data.get("fingerprints", {})
+
+        self.__current = dict[str, bool]()
+        self.__new_tiles = None
+        self.__new_slots = None
+        self.__new_fingerprints = None
+
+    def __len__(self) -> int:
+        return len(self.slots)
+
+    def get(self, path: str) -> numpy.ndarray | None:
+        slot = self.slots.get(path)
+        if slot is None or not self.__is_current(path):
+            return None
+        return self.tiles[slot]
+
+    def __is_current(self, path: str) -> bool:
+        # Images edited since they were rendered are loaded instead, and each one is only checked once
+        current = self.__current.get(path)
+        if current is None:
+            current = self.__matches(path, self.__fingerprint(path))
+            self.__current[path] = current
+        return current
+
+    def __matches(self, path: str, fingerprint: dict | None) -> bool:
+        return fingerprint is not None and fingerprint == self.fingerprints.get(path)
+
+    def __fingerprint(self, path: str) -> dict | None:
+        try:
+            return file_fingerprint(path)
+        except OSError:
+            return None
+
+    def begin(self, paths: list[str]) -> list[str]:
+        makedirs(self.path.parent, exist_ok=True)
+        shape = (len(paths), self.pixel_size, self.pixel_size, 3)
+        self.__new_tiles = numpy.lib.format.open_memmap(self.tmp_path, mode="w+", dtype=numpy.uint8, shape=shape)
+        self.__new_slots = {path: slot for slot, path in enumerate(paths)}
+        # Taken before rendering, so that images edited meanwhile are rendered again next time
+        self.__new_fingerprints = {path: self.__fingerprint(path) for path in paths}
+
+        # Tiles already in the atlas are copied over, the rest have to be rendered
+        missing_paths = []
+        for path, slot in self.__new_slots.items():
+            old_slot = self.slots.get(path)
+            if old_slot is None or not self.__matches(path, self.__new_fingerprints[path]):
+                missing_paths.append(path)
+            else:
+                self.__new_tiles[slot] = self.tiles[old_slot]
+        return missing_paths
+
+    def put(self, path: str, tile: numpy.ndarray):
+        self.__new_tiles[self.__new_slots[path]] = tile
+
+    def discard(self, path: str):
+        self.__new_slots.pop(path, None)
+        self.__new_fingerprints.pop(path, None)
+
+    def commit(self):
+        # Slots of discarded paths are left empty, rather than rewriting the atlas
+        count = len(self.__new_tiles)
+        self.__new_tiles.flush()
+        self.__new_tiles = None
+        self.tiles = None
+        replace(self.tmp_path, self.path)
+
+        slots_tmp_path = self.slots_path.with_suffix(".json.tmp")
+        with slots_tmp_path.open("w") as file:
+            file.write(json.dumps({"count": count, "slots": self.__new_slots, "fingerprints": self.__new_fingerprints}, sort_keys=True))
+        replace(slots_tmp_path, self.slots_path)
+
+        self.tiles = numpy.load(self.path, mmap_mode="r")
+        self.slots = self.__new_slots
+        self.fingerprints = self.__new_fingerprints
+        self.__current.clear()
+        self.__new_slots = None
+        self.__new_fingerprints = None
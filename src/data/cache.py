@@ -1,32 +1,127 @@
-import json
-from os import makedirs
-from platformdirs import user_data_path
+import numpy
+from typing import Iterable
+
+from utils.colors import KeyCodec, find_codes, keys_to_vectors
+from .storage import open_storage
+
+
+def closest_idxs(palette, color_keys: list[str], closest_keys: list[str | None]) -> numpy.ndarray:
+    # Colors matched to nothing are looked up like colors that were never cached
+    idxs = palette.index_of([closest_key or color_key for closest_key, color_key in zip(closest_keys, color_keys)])
+    idxs[numpy.array([closest_key is None for closest_key in closest_keys], dtype=bool)] = -1
+    return idxs
+
+
+class CompactCache:
+    # Colors are looked up by code, and map to indices of keys in a compact palette
+    def __init__(self, arrays: dict, codec: KeyCodec):
+        self.codec = codec
+        self.__sorted_codes = arrays["sorted_codes"]
+        self.__idxs = arrays["idxs"]
+        self.__new_idxs = dict()
+
+    @classmethod
+    def from_items(cls, items: Iterable[tuple[str, str]], codec: KeyCodec, palette) -> "CompactCache":
+        color_keys = []
+        closest_keys = []
+        for color_key, closest_key in items:
+            color_keys.append(color_key)
+            closest_keys.append(closest_key)
+
+        vectors = keys_to_vectors(color_keys).reshape(len(color_keys), codec.dims)
+        idxs = closest_idxs(palette, color_keys, closest_keys)
+        codes = codec.encode(vectors)
+        order = numpy.argsort(codes, kind="stable")
+        return cls({"sorted_codes": codes[order], "idxs": idxs[order]}, codec)
+
+    def to_arrays(self) -> dict:
+        return {"sorted_codes": self.__sorted_codes, "idxs": self.__idxs}
+
+    def __len__(self) -> int:
+        return len(self.__sorted_codes) + len(self.__new_idxs)
+
+    def find(self, codes: numpy.ndarray) -> numpy.ndarray:
+        positions = find_codes(self.__sorted_codes, codes)
+        found = positions >= 0
+        idxs = numpy.full(len(codes), -1, dtype=numpy.int64)
+        idxs[found] = self.__idxs[positions[found]]
+        if self.__new_idxs:
+            for pos in numpy.flatnonzero(idxs < 0).tolist():
+                idxs[pos] = self.__new_idxs.get(codes[pos].item(), -1)
+        return idxs
+
+    def set(self, codes: numpy.ndarray, idxs: numpy.ndarray):
+        for code, idx in zip(codes, idxs.tolist()):
+            self.__new_idxs[code.item()] = idx
 
 
 class Cache:
-    def __init__(self, profile: str):
-        self.path = user_data_path("img2mosaic", "Parslie").joinpath(f"cache.{profile}.json")
+    def __init__(self, profile: str, storage_type: str = "sqlite"):
+        self.storage = open_storage(f"cache.{profile}", storage_type)
+        self.path = self.storage.path
         print(f"Cache path: {self.path}")
-        
-        if self.path.exists():
-            with self.path.open("r") as file:
-                self.data = json.loads(file.read())
-        else:
-            self.data = {}
+
+        # Loaded on first access, since e.g. analysis only ever removes entries
+        self.__data = None
+        self.__updates = dict[str, str]()
+        self.__removed = set[str]()
+
+    @property
+    def data(self) -> dict:
+        if self.__data is None:
+            data = self.storage.load()
+            # Entries may have been changed before loading, without being saved yet
+            for key in self.__removed:
+                data.pop(key, None)
+            data.update(self.__updates)
+            self.__data = data
+        return self.__data
+
+    def compact(self, codec: KeyCodec, palette) -> CompactCache:
+        items = self.__data.items() if self.__data is not None else self.storage.items()
+        return CompactCache.from_items(items, codec, palette)
 
     def save(self):
-        makedirs(self.path.parent, exist_ok=True)
-        with self.path.open("w") as file:
-            file.write(json.dumps(self.data, sort_keys=True))
+        if self.storage.incremental:
+            self.storage.update(self.__updates, self.__removed)
+        else:
+            self.storage.write(self.data)
+        self.__updates.clear()
+        self.__removed.clear()
+
+    def take_updates(self) -> dict[str, str]:
+        # For entries that are saved by another process instead
+        updates = dict(self.__updates)
+        self.__updates.clear()
+        return updates
 
     def pop(self, key: str):
-        self.data.pop(key, None)
+        if self.__data is not None:
+            self.__data.pop(key, None)
+        self.__updates.pop(key, None)
+        self.__removed.add(key)
     
+    def pop_values(self, vals: set[str]):
+        for key in [key for key, val in self.data.items() if val in vals]:
+            self.pop(key)
+
+    def get_many(self, keys: list[str]) -> dict:
+        # Looked up in storage when possible, so that only the entries asked for are loaded
+        if self.__data is None and self.storage.incremental:
+            entries = self.storage.get_many(keys)
+            entries.update((key, self.__updates[key]) for key in keys if key in self.__updates)
+            return {key: val for key, val in entries.items() if key not in self.__removed}
+        return {key: self.data[key] for key in keys if key in self.data}
+
     def get(self, key: str, default) -> str:
         return self.data.get(key, default)
     
     def set(self, key: str, val: str):
-        self.data[key] = val
+        # Storage that is saved incrementally doesn't need to be loaded, just to be written to
+        if self.__data is not None or not self.storage.incremental:
+            self.data[key] = val
+        self.__updates[key] = val
+        self.__removed.discard(key)
 
     def contains(self, key: str) -> bool:
         return key in self.data.keys()
@@ -0,0 +1,35 @@
+import numpy
+from os import makedirs, replace
+
+from .storage import data_path
+
+
+class LookupTable:
+    def __init__(self, profile: str, complexity: int):
+        self.path = data_path().joinpath(f"lut.{profile}.npz")
+        self.complexity = complexity
+        print(f"Lookup table path: {self.path}")
+
+        self.table = None
+        self.keys = []
+        if self.path.exists():
+            with numpy.load(self.path) as arrays:
+                self.table = arrays["table"]
+                self.keys = arrays["keys"].tolist()
+
+    def matches(self, keys: list[str]) -> bool:
+        # The table is stale once the palette has gained keys since it was computed
+        return self.table is not None and len(self.keys) > 0 and sorted(self.keys) == sorted(keys)
+
+    def lookup(self, colors: numpy.ndarray) -> numpy.ndarray:
+        quantized = colors // self.complexity
+        return self.table[quantized[..., 0], quantized[..., 1], quantized[..., 2]]
+
+    def save(self, table: numpy.ndarray, keys: list[str]):
+        makedirs(self.path.parent, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp.npz")
+        numpy.savez(tmp_path, table=table, keys=numpy.array(keys, dtype=str))
+        replace(tmp_path, self.path)
+
+        self.table = table
+        self.keys = list(keys)
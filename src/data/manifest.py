@@ -0,0 +1,40 @@
+from .storage import open_storage
+
+
+class Manifest:
+    def __init__(self, profile: str, storage_type: str = "sqlite"):
+        self.storage = open_storage(f"manifest.{profile}", storage_type)
+        self.path = self.storage.path
+        print(f"Manifest path: {self.path}")
+
+        self.__data = None
+        self.__changed = set[str]()
+        self.__removed = set[str]()
+
+    @property
+    def data(self) -> dict:
+        if self.__data is None:
+            self.__data = self.storage.load()
+        return self.__data
+
+    def save(self):
+        if self.storage.incremental:
+            entries = {path: self.__data[path] for path in self.__changed}
+            self.storage.update(entries, self.__removed)
+        else:
+            self.storage.write(self.data)
+        self.__changed.clear()
+        self.__removed.clear()
+
+    def pop(self, path: str):
+        self.data.pop(path, None)
+        self.__changed.discard(path)
+        self.__removed.add(path)
+
+    def get(self, path: str, default) -> dict:
+        return self.data.get(path, default)
+
+    def set(self, path: str, val: dict):
+        self.data[path] = val
+        self.__changed.add(path)
+        self.__removed.discard(path)
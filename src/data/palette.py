@@ -1,33 +1,220 @@
-import json
+import numpy
+from array import array
 from os import makedirs
-from platformdirs import user_data_path
+from typing import Iterable
+
+from utils.colors import KeyCodec, find_codes, keys_to_vectors, vector_to_key
+from utils.kdtree import KDTree
+from utils.matching import Matcher
+from .storage import open_storage
+
+# The index only beats a full scan for large, low-dimensional palettes, even when matches may be approximate
+INDEX_MIN_KEYS = 10_000
+INDEX_MAX_DIMS = 3
+
+
+def uses_index(count: int, dims: int) -> bool:
+    return count >= INDEX_MIN_KEYS and dims <= INDEX_MAX_DIMS
+
+
+class CompactPalette:
+    # Keys are packed into one array, and their paths into one table of encoded paths, delimited by offsets
+    def __init__(self, arrays: dict, codec: KeyCodec, keys: list[str] = None):
+        self.codec = codec
+        self.vectors = arrays["vectors"]
+        self.path_data = arrays["path_data"]
+        self.path_offsets = arrays["path_offsets"]
+        self.offsets = arrays["offsets"]
+        self.__order = arrays["order"]
+        self.__sorted_codes = arrays["sorted_codes"]
+        self.__keys = keys
+
+    @classmethod
+    def from_items(cls, items: Iterable[tuple[str, list]], codec: KeyCodec) -> "CompactPalette":
+        keys = []
+        path_data = bytearray()
+        path_ends = array("q")
+        key_ends = array("q")
+        for key, img_list in items:
+            keys.append(key)
+            for path in img_list:
+                path_data += path.encode("utf-8")
+                path_ends.append(len(path_data))
+            key_ends.append(len(path_ends))
+
+        vectors = keys_to_vectors(keys).reshape(len(keys), codec.dims)
+        codes = codec.encode(vectors)
+        order = numpy.argsort(codes, kind="stable")
+        arrays = {
+            "vectors": vectors,
+            "path_data": numpy.frombuffer(path_data, dtype=numpy.uint8),
+            "path_offsets": numpy.concatenate(([0], numpy.frombuffer(path_ends, dtype=numpy.int64))),
+            "offsets": numpy.concatenate(([0], numpy.frombuffer(key_ends, dtype=numpy.int64))),
+            "order": order,
+            "sorted_codes": codes[order],
+        }
+        return cls(arrays, codec, keys)
+
+    def to_arrays(self) -> dict:
+        return {
+            "vectors": self.vectors,
+            "path_data": self.path_data,
+            "path_offsets": self.path_offsets,
+            "offsets": self.offsets,
+            "order": self.__order,
+            "sorted_codes": self.__sorted_codes,
+        }
+
+    @property
+    def keys(self) -> list[str]:
+        # Decoding every key of a large palette takes seconds, and generation only needs single keys
+        if self.__keys is None:
+            self.__keys = [vector_to_key(vector) for vector in self.vectors]
+        return self.__keys
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    def key(self, idx: int) -> str:
+        return vector_to_key(self.vectors[idx])
+
+    def find(self, codes: numpy.ndarray) -> numpy.ndarray:
+        positions = find_codes(self.__sorted_codes, codes)
+        found = positions >= 0
+        idxs = numpy.full(len(codes), -1, dtype=numpy.int64)
+        idxs[found] = self.__order[positions[found]]
+        return idxs
+
+    def index_of(self, keys: list[str]) -> numpy.ndarray:
+        return self.find(self.codec.encode(keys_to_vectors(keys).reshape(len(keys), self.codec.dims)))
+
+    def path(self, path_idx: int) -> str:
+        start, end = self.path_offsets[path_idx:path_idx + 2].tolist()
+        return self.path_data[start:end].tobytes().decode("utf-8")
+
+    def img_list(self, idx: int) -> list[str]:
+        start, end = self.offsets[idx:idx + 2].tolist()
+        return [self.path(path_idx) for path_idx in range(start, end)]
+
+    def paths(self) -> list[str]:
+        return [self.path(path_idx) for path_idx in range(len(self.path_offsets) - 1)]
 
 
 class Palette:
-    def __init__(self, profile: str):
-        self.path = user_data_path("img2mosaic", "Parslie").joinpath(f"palette.{profile}.json")
+    def __init__(self, profile: str, storage_type: str = "sqlite"):
+        self.storage = open_storage(f"palette.{profile}", storage_type)
+        self.path = self.storage.path
         print(f"Palette path: {self.path}")
 
-        if self.path.exists():
-            with self.path.open("r") as file:
-                self.data = json.loads(file.read())
-        else:
-            self.data = {}
+        self.__data = None
+        self.__changed = set[str]()
+        self.__removed = set[str]()
+
+        self.index_path = self.path.with_name(f"palette.{profile}.index.npz")
+        self.__index = None
+        self.__index_stale = False
+        self.__compact = None
+
+    @property
+    def data(self) -> dict:
+        if self.__data is None:
+            self.__data = self.storage.load()
+        return self.__data
 
     def save(self):
-        makedirs(self.path.parent, exist_ok=True)
-        with self.path.open("w") as file:
-            file.write(json.dumps(self.data, sort_keys=True))
+        if self.storage.incremental:
+            entries = {key: self.__data[key] for key in self.__changed}
+            self.storage.update(entries, self.__removed)
+        else:
+            self.storage.write(self.data)
+        self.__changed.clear()
+        self.__removed.clear()
+
+        if self.__index_stale:
+            self.index_path.unlink(missing_ok=True)
+            self.__index_stale = False
+
+    def compact(self, codec: KeyCodec) -> CompactPalette:
+        # Packed straight from storage when possible, since the dict alone can take gigabytes
+        if self.__compact is None:
+            items = self.__data.items() if self.__data is not None else self.storage.items()
+            self.__compact = CompactPalette.from_items(items, codec)
+        return self.__compact
+
+    def index(self) -> tuple[list[str], KDTree]:
+        if self.__index is None:
+            self.__index = self.__load_index() or self.__build_index()
+        return self.__index
+
+    def __load_index(self) -> tuple[list[str], KDTree] | None:
+        if not self.index_path.exists():
+            return None
+
+        with numpy.load(self.index_path) as arrays:
+            keys = arrays["keys"].tolist()
+            # The index is stale if the palette was changed without saving over it
+            if keys != sorted(self.keys()):
+                return None
+            return keys, KDTree.from_arrays(arrays)
+
+    def __build_index(self) -> tuple[list[str], KDTree]:
+        keys = sorted(self.keys())
+        tree = KDTree(keys_to_vectors(keys))
+
+        makedirs(self.index_path.parent, exist_ok=True)
+        numpy.savez(self.index_path, keys=numpy.array(keys, dtype=str), **tree.to_arrays())
+        return keys, tree
+
+    def matcher(self, epsilon: float = 0.0) -> Matcher:
+        keys = self.keys()
+        dims = len(keys[0].split(" ")) if keys else 0
+
+        if uses_index(len(keys), dims):
+            keys, tree = self.index()
+            return Matcher(keys, tree, epsilon)
+        return Matcher(keys)
 
     @property
     def paths(self) -> set:
+        if self.__data is None and self.__compact is not None:
+            return set(self.__compact.paths())
         paths = set()
         for path in self.data.values():
             paths.update(path)
         return paths
     
+    def keys(self) -> list[str]:
+        if self.__data is None and self.__compact is not None:
+            return list(self.__compact.keys)
+        return list(self.data.keys())
+
     def get(self, key: str, default: list) -> list:
         return self.data.get(key, default)
 
     def set(self, key: str, val: list):
+        if key not in self.data:
+            self.__index = None
+            self.__index_stale = True
         self.data[key] = val
+        self.__compact = None
+        self.__changed.add(key)
+        self.__removed.discard(key)
+
+    def remove(self, key: str, path: str) -> bool:
+        img_list = self.data.get(key, [])
+        if path not in img_list:
+            return False
+
+        img_list.remove(path)
+        self.__compact = None
+        if img_list:
+            self.__changed.add(key)
+            return False
+
+        # Keys without any images are removed altogether
+        self.data.pop(key)
+        self.__changed.discard(key)
+        self.__removed.add(key)
+        self.__index = None
+        self.__index_stale = True
+        return True
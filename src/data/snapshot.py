@@ -0,0 +1,92 @@
+import json
+import numpy
+import shutil
+from os import makedirs, replace
+
+from utils.colors import KeyCodec
+from utils.kdtree import KDTree
+from utils.matching import Matcher
+from .cache import CompactCache
+from .palette import CompactPalette, uses_index
+from .storage import data_path
+
+# Changed whenever the arrays of a snapshot are, so that old snapshots are ignored
+SNAPSHOT_FORMAT = 1
+
+
+class Snapshot:
+    # Arrays are saved one per file, so that every process generating with them maps the same pages
+    def __init__(self, profile: str, codec: KeyCodec):
+        dir_path = data_path()
+        self.path = dir_path.joinpath(f"snapshot.{profile}")
+        self.tmp_path = dir_path.joinpath(f"snapshot.{profile}.tmp")
+        self.old_path = dir_path.joinpath(f"snapshot.{profile}.old")
+        self.codec = codec
+        print(f"Snapshot path: {self.path}")
+
+        self.palette = None
+        self.cache = None
+        self.__arrays = {}
+
+    def load(self, palette_path: str, palette_version: list) -> bool:
+        meta_path = self.path.joinpath("snapshot.json")
+        if not meta_path.exists():
+            return False
+        with meta_path.open("r") as file:
+            meta = json.loads(file.read())
+
+        # A snapshot of a palette that has since been changed would match colors to the wrong images
+        if meta["format"] != SNAPSHOT_FORMAT or meta["palette_path"] != str(palette_path) or meta["palette_version"] != palette_version:
+            print("Snapshot is out of date, and is not used")
+            return False
+
+        self.__arrays = {name: numpy.load(self.path.joinpath(f"{name}.npy"), mmap_mode="r") for name in meta["arrays"]}
+        self.palette = CompactPalette(self.__group("palette"), self.codec)
+        self.cache = CompactCache(self.__group("cache"), self.codec)
+        return True
+
+    def matcher(self, epsilon: float = 0.0) -> Matcher:
+        # Indices of both the matcher and the index are indices of the palette, since it's saved in the same order
+        tree = None
+        if uses_index(len(self.palette), self.codec.dims):
+            tree = KDTree.from_arrays(self.__group("index"))
+        return Matcher.from_arrays(self.__group("matcher"), tree, epsilon)
+
+    def __group(self, group: str) -> dict:
+        prefix = f"{group}."
+        return {name[len(prefix):]: arrays for name, arrays in self.__arrays.items() if name.startswith(prefix)}
+
+    def write(self, palette: CompactPalette, cache: CompactCache, matcher: Matcher, tree: KDTree, palette_path: str, palette_version: list):
+        groups = {
+            "palette": palette.to_arrays(),
+            "cache": cache.to_arrays(),
+            "matcher": matcher.to_arrays(),
+            "index": tree.to_arrays(),
+        }
+
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        makedirs(self.tmp_path)
+        names = []
+        for group, arrays in groups.items():
+            for name, array in arrays.items():
+                names.append(f"{group}.{name}")
+                numpy.save(self.tmp_path.joinpath(f"{group}.{name}.npy"), numpy.ascontiguousarray(array))
+
+        meta = {
+            "format": SNAPSHOT_FORMAT,
+            "palette_path": str(palette_path),
+            "palette_version": palette_version,
+            "arrays": names,
+        }
+        with self.tmp_path.joinpath("snapshot.json").open("w") as file:
+            file.write(json.dumps(meta, sort_keys=True))
+
+        # Processes that already mapped the old snapshot keep reading it until they exit
+        shutil.rmtree(self.old_path, ignore_errors=True)
+        if self.path.exists():
+            replace(self.path, self.old_path)
+        replace(self.tmp_path, self.path)
+        shutil.rmtree(self.old_path, ignore_errors=True)
+
+    def size(self) -> int:
+        return sum(path.stat().st_size for path in self.path.iterdir())
@@ -0,0 +1,137 @@
+import json
+import os
+import sqlite3
+from contextlib import closing
+from typing import Iterator
+from os import makedirs, replace
+from pathlib import Path
+from platformdirs import user_data_path
+
+from utils.metrics import metrics
+
+STORAGE_TYPES = ("sqlite", "json")
+# Amount of keys looked up per query, below the limit of parameters per statement
+QUERY_BATCH_SIZE = 500
+# Overrides where data is kept, on every platform, which also reaches worker processes
+DATA_DIR_ENV = "IMG2MOSAIC_DATA_DIR"
+
+
+def data_path() -> Path:
+    if data_dir := os.environ.get(DATA_DIR_ENV):
+        return Path(data_dir)
+    return user_data_path("img2mosaic", "Parslie")
+
+
+class JsonStorage:
+    # Every save rewrites the whole file
+    incremental = False
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.kind = path.name.split(".")[0]
+
+    def load(self) -> dict:
+        if not self.path.exists():
+            return {}
+        with metrics.timer(f"{self.kind}.load"), self.path.open("r") as file:
+            return json.loads(file.read())
+
+    def items(self) -> Iterator[tuple[str, object]]:
+        return iter(self.load().items())
+
+    def version(self) -> list:
+        # Every save replaces the file, so its modification time changes along with its contents
+        if not self.path.exists():
+            return []
+        stat = self.path.stat()
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def write(self, data: dict):
+        makedirs(self.path.parent, exist_ok=True)
+        # Replacing a finished file means a crash mid-write never corrupts the previous save
+        tmp_path = self.path.with_suffix(".json.tmp")
+        with metrics.timer(f"{self.kind}.save"), tmp_path.open("w") as file:
+            file.write(json.dumps(data, sort_keys=True))
+        replace(tmp_path, self.path)
+
+
+class SqliteStorage:
+    # Saves only write the entries that have changed
+    incremental = True
+
+    def __init__(self, path: Path, json_path: Path):
+        self.path = path
+        self.json_path = json_path
+        self.kind = path.name.split(".")[0]
+
+    def __connect(self) -> sqlite3.Connection:
+        if not self.path.exists() and self.json_path.exists():
+            self.__migrate()
+
+        makedirs(self.path.parent, exist_ok=True)
+        connection = sqlite3.connect(self.path)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        return connection
+
+    def __migrate(self):
+        data = JsonStorage(self.json_path).load()
+
+        # Migrated into a separate file first, so that an interrupted migration is simply redone
+        tmp_path = self.path.with_suffix(".sqlite3.tmp")
+        tmp_path.unlink(missing_ok=True)
+        with closing(sqlite3.connect(tmp_path)) as connection, connection:
+            connection.execute("CREATE TABLE entries (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            connection.executemany(
+                "INSERT INTO entries VALUES (?, ?)",
+                ((key, json.dumps(value)) for key, value in data.items()),
+            )
+        replace(tmp_path, self.path)
+        print(f"Migrated {self.json_path} to {self.path}")
+
+    def load(self) -> dict:
+        return dict(self.items())
+
+    def items(self) -> Iterator[tuple[str, object]]:
+        # Rows are decoded one at a time, so that they can be packed without loading a dict first
+        with metrics.timer(f"{self.kind}.load"), closing(self.__connect()) as connection:
+            for key, value in connection.execute("SELECT key, value FROM entries ORDER BY key"):
+                yield key, json.loads(value)
+
+    def get_many(self, keys: list[str]) -> dict:
+        entries = {}
+        with closing(self.__connect()) as connection:
+            for start in range(0, len(keys), QUERY_BATCH_SIZE):
+                batch_keys = keys[start:start + QUERY_BATCH_SIZE]
+                placeholders = ", ".join("?" * len(batch_keys))
+                for key, value in connection.execute(f"SELECT key, value FROM entries WHERE key IN ({placeholders})", batch_keys):
+                    entries[key] = json.loads(value)
+        return entries
+
+    def version(self) -> list:
+        # Counted up by every update, since modification times don't cover writes still in the WAL
+        if not self.path.exists() and not self.json_path.exists():
+            return []
+        with closing(self.__connect()) as connection:
+            return [connection.execute("PRAGMA user_version").fetchone()[0]]
+
+    def update(self, entries: dict, removed: set):
+        with metrics.timer(f"{self.kind}.save"), closing(self.__connect()) as connection, connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?)",
+                ((key, json.dumps(value)) for key, value in entries.items()),
+            )
+            connection.executemany("DELETE FROM entries WHERE key = ?", ((key,) for key in removed))
+            if entries or removed:
+                # Pragmas can't be parameterized, but the version is always an integer
+                version = connection.execute("PRAGMA user_version").fetchone()[0]
+                connection.execute(f"PRAGMA user_version = {version + 1}")
+
+
+def open_storage(name: str, storage_type: str) -> JsonStorage | SqliteStorage:
+    dir_path = data_path()
+    json_path = dir_path.joinpath(f"{name}.json")
+
+    if storage_type == "json":
+        return JsonStorage(json_path)
+    return SqliteStorage(dir_path.joinpath(f"{name}.sqlite3"), json_path)
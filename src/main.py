@@ -1,13 +1,23 @@
 from actions.analysis import Analyze
+from actions.atlas import Atlas
 from actions.cache import Cache
 from actions.generation import Generate
+from actions.serve import Serve
+from actions.snapshot import Snapshot
 from arguments.parsers import get_args 
+from utils.metrics import metrics
 
 
 def main():
     args = get_args()
     action = None
 
+    # Enabled before the action is created, so that loading its data is measured too
+    if args.metrics:
+        metrics.enable()
+        if args.metrics_interval:
+            metrics.start_periodic(args.metrics, args.metrics_interval)
+
     match args.action:
         case "generate":
             action = Generate(args)
@@ -15,11 +25,21 @@ def main():
             action = Analyze(args)
         case "cache":
             action = Cache(args)
+        case "atlas":
+            action = Atlas(args)
+        case "serve":
+            action = Serve(args)
+        case "snapshot":
+            action = Snapshot(args)
 
     try:
         action.run()
     except KeyboardInterrupt:
         action.cancel()
+    finally:
+        if args.metrics:
+            metrics.stop_periodic()
+            metrics.write(args.metrics)
 
 
 if __name__ == '__main__':
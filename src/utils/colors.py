@@ -9,6 +9,17 @@ def clamp_color(color: numpy.ndarray, complexity: int) -> numpy.ndarray:
     return color
 
 
+def clamp_colors(colors: numpy.ndarray, complexity: int) -> numpy.ndarray:
+    return colors - colors % complexity
+
+
+def img_to_block_vectors(img: numpy.ndarray, density: int) -> numpy.ndarray:
+    # Every block's colors are laid out row by row, in the same order as its key
+    height, width, _ = img.shape
+    blocks = img.reshape(height // density, density, width // density, density, 3)
+    return blocks.transpose(0, 2, 1, 3, 4).reshape(-1, density * density * 3)
+
+
 def colors_to_key(colors: list[numpy.ndarray]) -> str:
     key = ''
     for color in colors:
@@ -27,6 +38,52 @@ def key_to_colors(key: str) -> list[numpy.ndarray]:
     return colors
 
 
+def key_to_vector(key: str) -> numpy.ndarray:
+    return numpy.array([int(x) for x in key.split(' ')], dtype=numpy.uint8)
+
+
+def keys_to_vectors(keys: list[str]) -> numpy.ndarray:
+    if not keys:
+        return numpy.empty((0, 0), dtype=numpy.uint8)
+    # Parsed by numpy in one pass, rather than through a list of every value
+    values = numpy.fromstring(' '.join(keys), dtype=numpy.uint8, sep=' ')
+    return values.reshape(len(keys), -1)
+
+
+def vector_to_key(vector: numpy.ndarray) -> str:
+    return ' '.join(map(str, vector.tolist()))
+
+
+class KeyCodec:
+    # Packs clamped color vectors into integers, so that they can be sorted and searched without building keys
+    def __init__(self, dims: int, complexity: int):
+        self.dims = dims
+        self.complexity = complexity
+
+        bits = (len(range(0, 256, complexity)) - 1).bit_length()
+        self.packed = bits * dims <= 63
+        self.shifts = numpy.arange(dims, dtype=numpy.int64) * bits
+
+    def encode(self, vectors: numpy.ndarray) -> numpy.ndarray:
+        vectors = numpy.ascontiguousarray(vectors, dtype=numpy.uint8).reshape(len(vectors), self.dims)
+        if self.packed:
+            # Packed a column at a time, since the whole array widened to int64 can be larger than the palette
+            codes = numpy.zeros(len(vectors), dtype=numpy.int64)
+            for dim, shift in enumerate(self.shifts.tolist()):
+                codes |= (vectors[:, dim] // self.complexity).astype(numpy.int64) << shift
+            return codes
+        # Too many colors to fit an integer, so rows are compared as raw bytes instead
+        return vectors.view(numpy.dtype((numpy.void, self.dims))).reshape(-1)
+
+
+def find_codes(sorted_codes: numpy.ndarray, codes: numpy.ndarray) -> numpy.ndarray:
+    # Positions of the codes in the sorted codes, or -1 for codes that aren't in them
+    if not len(sorted_codes):
+        return numpy.full(len(codes), -1, dtype=numpy.intp)
+    positions = numpy.minimum(numpy.searchsorted(sorted_codes, codes), len(sorted_codes) - 1)
+    return numpy.where(sorted_codes[positions] == codes, positions, -1)
+
+
 def color_sqr_dist(color_1: numpy.ndarray, color_2: numpy.ndarray) -> float:
     diff_b = int(color_1[0]) - int(color_2[0])
     diff_g = int(color_1[1]) - int(color_2[1])
@@ -0,0 +1,34 @@
+from os import scandir, stat
+from os import path as os_path
+from typing import Generator
+
+from arguments.types import VALID_IMAGE_EXTS # TODO: should be handled differently
+
+
+def file_fingerprint(path: str) -> dict:
+    file_stat = stat(path)
+    return {"size": file_stat.st_size, "mtime": file_stat.st_mtime_ns}
+
+
+def iter_image_paths(dir: str, recursive: bool) -> Generator[str, None, None]:
+    dirs = [dir]
+    # Linked directories are followed, but each real directory is only scanned once, so links can't loop
+    visited_dirs = {os_path.realpath(dir)}
+    while dirs:
+        current_dir = dirs.pop()
+        try:
+            with scandir(current_dir) as entries:
+                for entry in entries:
+                    # Hidden files are skipped, like glob does
+                    if entry.name.startswith("."):
+                        continue
+                    if entry.is_dir():
+                        real_path = os_path.realpath(entry.path)
+                        if recursive and real_path not in visited_dirs:
+                            visited_dirs.add(real_path)
+                            dirs.append(entry.path)
+                    elif os_path.splitext(entry.name)[1][1:].lower() in VALID_IMAGE_EXTS and entry.is_file():
+                        yield entry.path
+        except OSError:
+            # Unreadable directories are skipped, rather than stopping the whole scan
+            continue
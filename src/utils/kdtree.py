@@ -0,0 +1,135 @@
+import numpy
+
+# Max amount of points in a leaf, which are compared to a query all at once
+LEAF_SIZE = 32
+
+
+class KDTree:
+    def __init__(self, vectors: numpy.ndarray, leaf_size: int = LEAF_SIZE):
+        vectors = numpy.asarray(vectors, dtype=numpy.uint8)
+        self.order = numpy.arange(len(vectors), dtype=numpy.intp)
+
+        self.__nodes = []
+        if len(vectors):
+            self.__build(vectors, 0, len(vectors), leaf_size)
+
+        arrays = {
+            "vectors": vectors[self.order],
+            "order": self.order,
+            "split_dims": numpy.array([node[0] for node in self.__nodes], dtype=numpy.intp),
+            "split_vals": numpy.array([node[1] for node in self.__nodes], dtype=numpy.float64),
+            "children": numpy.array([node[2] for node in self.__nodes], dtype=numpy.intp).reshape(-1, 2),
+            "bounds": numpy.array([node[3] for node in self.__nodes], dtype=numpy.intp).reshape(-1, 2),
+        }
+        self.__load_arrays(arrays)
+
+    @classmethod
+    def from_arrays(cls, arrays: dict) -> "KDTree":
+        tree = cls.__new__(cls)
+        tree.__load_arrays(arrays)
+        return tree
+
+    def to_arrays(self) -> dict:
+        return {
+            "vectors": self.vectors,
+            "order": self.order,
+            "split_dims": self.split_dims,
+            "split_vals": self.split_vals,
+            "children": self.children,
+            "bounds": self.bounds,
+        }
+
+    def __load_arrays(self, arrays: dict):
+        self.vectors = numpy.asarray(arrays["vectors"], dtype=numpy.uint8)
+        self.order = numpy.asarray(arrays["order"], dtype=numpy.intp)
+        self.split_dims = numpy.asarray(arrays["split_dims"], dtype=numpy.intp)
+        self.split_vals = numpy.asarray(arrays["split_vals"], dtype=numpy.float64)
+        self.children = numpy.asarray(arrays["children"], dtype=numpy.intp)
+        self.bounds = numpy.asarray(arrays["bounds"], dtype=numpy.intp)
+
+        # Python lists are considerably faster than numpy scalars during traversal
+        self.__points = self.vectors.astype(numpy.float64)
+        self.__node_lists = (
+            self.split_dims.tolist(),
+            self.split_vals.tolist(),
+            self.children.tolist(),
+            self.bounds.tolist(),
+        )
+
+    def __build(self, vectors: numpy.ndarray, start: int, end: int, leaf_size: int) -> int:
+        node = len(self.__nodes)
+        self.__nodes.append([-1, 0, (-1, -1), (start, end)])
+        if end - start <= leaf_size:
+            return node
+
+        # Splits on the widest dimension, at its median
+        indices = self.order[start:end]
+        section = vectors[indices]
+        extents = section.max(axis=0).astype(int) - section.min(axis=0)
+        dim = int(extents.argmax())
+        if extents[dim] == 0:
+            return node
+
+        mid = (end - start) // 2
+        partition = numpy.argpartition(section[:, dim], mid)
+        self.order[start:end] = indices[partition]
+        split_val = int(vectors[self.order[start + mid], dim])
+
+        left = self.__build(vectors, start, start + mid, leaf_size)
+        right = self.__build(vectors, start + mid, end, leaf_size)
+        self.__nodes[node][:3] = [dim, split_val, (left, right)]
+        return node
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+    def query(self, vectors: numpy.ndarray, epsilon: float = 0.0) -> numpy.ndarray:
+        indices = numpy.full(len(vectors), -1, dtype=numpy.intp)
+        if not len(self) or not len(vectors):
+            return indices
+
+        # Subtrees are skipped when they cannot contain anything closer than best / (1 + epsilon),
+        # so an approximate match is at most (1 + epsilon) times further away than the exact one.
+        scale = (1 + epsilon) ** 2
+        vectors = numpy.asarray(vectors, dtype=numpy.float64).reshape(len(vectors), -1)
+        for idx, vector in enumerate(vectors):
+            indices[idx] = self.__query_one(vector, scale)
+        return indices
+
+    def __query_one(self, vector: numpy.ndarray, scale: float) -> int:
+        split_dims, split_vals, children, bounds = self.__node_lists
+        points = self.__points
+        order = self.order
+
+        values = vector.tolist()
+        offsets = [0.0] * len(values)
+        best = [float("inf"), -1]
+
+        def visit(node: int, min_dist: float):
+            split_dim = split_dims[node]
+            if split_dim < 0:
+                start, end = bounds[node]
+                sqr_dists = ((points[start:end] - vector) ** 2).sum(axis=1)
+                dist = float(sqr_dists.min())
+                if dist <= best[0]:
+                    # Ties resolve to the lowest original index, like Matcher does
+                    idx = int(order[start:end][sqr_dists == dist].min())
+                    if dist < best[0] or idx < best[1]:
+                        best[0], best[1] = dist, idx
+                return
+
+            left, right = children[node]
+            diff = values[split_dim] - split_vals[node]
+            near, far = (left, right) if diff < 0 else (right, left)
+            visit(near, min_dist)
+
+            old_offset = offsets[split_dim]
+            far_dist = min_dist - old_offset ** 2 + diff ** 2
+            # Exact queries visit equally distant subtrees too, since they may hold an earlier key
+            if far_dist * scale < best[0] or (scale == 1 and far_dist == best[0]):
+                offsets[split_dim] = diff
+                visit(far, far_dist)
+                offsets[split_dim] = old_offset
+
+        visit(0, 0.0)
+        return best[1]
@@ -0,0 +1,97 @@
+import numpy
+
+from .colors import keys_to_vectors, vector_to_key
+from .kdtree import KDTree
+
+# Upper bound of elements in a single query chunk's distance matrix
+MAX_CHUNK_ELEMENTS = 1 << 22
+# Amount of matches compared at once, when looking for closer keys
+REFRESH_BATCH_SIZE = 1 << 16
+
+
+class Matcher:
+    def __init__(self, keys: list[str], tree: KDTree = None, epsilon: float = 0.0):
+        self.__keys = list(keys)
+        self.tree = tree
+        self.epsilon = epsilon
+
+        # Distances are only compared, so |query|^2 can be left out.
+        # All terms are integers well below 2^53, so float64 is exact.
+        vectors = numpy.ascontiguousarray(keys_to_vectors(self.__keys))
+        features = vectors.astype(numpy.float64)
+        self.__load_arrays({"vectors": vectors, "features": features, "sqr_norms": (features ** 2).sum(axis=1)})
+
+    @classmethod
+    def from_arrays(cls, arrays: dict, tree: KDTree = None, epsilon: float = 0.0) -> "Matcher":
+        matcher = cls.__new__(cls)
+        matcher.__keys = None
+        matcher.tree = tree
+        matcher.epsilon = epsilon
+        matcher.__load_arrays(arrays)
+        return matcher
+
+    def to_arrays(self) -> dict:
+        return {"vectors": self.vectors, "features": self.__features, "sqr_norms": self.__sqr_norms}
+
+    def __load_arrays(self, arrays: dict):
+        self.vectors = arrays["vectors"]
+        self.__features = arrays["features"]
+        self.__sqr_norms = arrays["sqr_norms"]
+
+    @property
+    def keys(self) -> list[str]:
+        if self.__keys is None:
+            self.__keys = [vector_to_key(vector) for vector in self.vectors]
+        return self.__keys
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    def closest_indices(self, vectors: numpy.ndarray) -> numpy.ndarray:
+        indices = numpy.full(len(vectors), -1, dtype=numpy.intp)
+        if not len(self.vectors) or not len(vectors):
+            return indices
+        if self.tree is not None:
+            return self.tree.query(vectors, self.epsilon)
+
+        vectors = numpy.asarray(vectors, dtype=numpy.float64).reshape(len(vectors), -1)
+        chunk_size = max(1, MAX_CHUNK_ELEMENTS // len(self.vectors))
+        for start in range(0, len(vectors), chunk_size):
+            chunk = vectors[start:start + chunk_size]
+            sqr_dists = self.__sqr_norms - 2 * (chunk @ self.__features.T)
+            # argmin picks the first minimum, i.e. the earliest palette key on ties
+            indices[start:start + chunk_size] = sqr_dists.argmin(axis=1)
+
+        return indices
+
+    def closest_keys(self, vectors: numpy.ndarray) -> list[str]:
+        return [self.keys[idx] if idx >= 0 else None for idx in self.closest_indices(vectors)]
+
+    def closest_key(self, colors: list[numpy.ndarray]) -> str:
+        vector = numpy.concatenate(colors)
+        return self.closest_keys(vector[numpy.newaxis])[0]
+
+
+def find_closer_keys(color_keys: list[str], closest_keys: list[str | None], new_keys: list[str]) -> list[tuple[str, str]]:
+    # Only the new keys are searched, since every other key was already compared when the match was made
+    closer_keys = []
+    if not new_keys:
+        return closer_keys
+    matcher = Matcher(new_keys)
+
+    for start in range(0, len(color_keys), REFRESH_BATCH_SIZE):
+        batch_keys = color_keys[start:start + REFRESH_BATCH_SIZE]
+        batch_closest_keys = closest_keys[start:start + REFRESH_BATCH_SIZE]
+        colors = keys_to_vectors(batch_keys).astype(numpy.int32)
+
+        new_idxs = matcher.closest_indices(colors)
+        new_sqr_dists = ((colors - matcher.vectors[new_idxs]) ** 2).sum(axis=1)
+        # Colors without a match are closer to anything
+        closest = keys_to_vectors([key or color_key for key, color_key in zip(batch_closest_keys, batch_keys)])
+        sqr_dists = ((colors - closest) ** 2).sum(axis=1).astype(numpy.float64)
+        sqr_dists[numpy.array([key is None for key in batch_closest_keys], dtype=bool)] = numpy.inf
+
+        for idx in numpy.flatnonzero(new_sqr_dists < sqr_dists).tolist():
+            closer_keys.append((batch_keys[idx], new_keys[new_idxs[idx]]))
+
+    return closer_keys
@@ -0,0 +1,189 @@
+import bisect
+import json
+from contextlib import contextmanager
+from os import makedirs, path as os_path, replace
+from threading import Event, Lock, Thread
+from time import perf_counter
+from typing import Generator
+
+# Upper bounds of the latency buckets, in seconds
+HISTOGRAM_BUCKETS = (
+    1e-6, 5e-6, 1e-5, 5e-5, 1e-4, 5e-4,
+    1e-3, 5e-3, 0.01, 0.05, 0.1, 0.5,
+    1.0, 5.0, 10.0,
+)
+PROMETHEUS_EXTS = ("prom",)
+PROMETHEUS_PREFIX = "img2mosaic"
+
+
+class Histogram:
+    def __init__(self):
+        # The last bucket holds everything above the largest bound
+        self.buckets = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.buckets[bisect.bisect_left(HISTOGRAM_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def merge(self, other: dict):
+        for idx, count in enumerate(other["buckets"]):
+            self.buckets[idx] += count
+        self.count += other["count"]
+        self.sum += other["sum"]
+        if other["count"]:
+            self.min = min(self.min, other["min"])
+            self.max = max(self.max, other["max"])
+
+    def quantile(self, q: float) -> float:
+        # Only as precise as the buckets, so the bound of the bucket is reported
+        rank = q * self.count
+        seen = 0
+        for idx, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                return HISTOGRAM_BUCKETS[idx] if idx < len(HISTOGRAM_BUCKETS) else self.max
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {
+            "buckets": list(self.buckets),
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min if self.count else 0.0,
+            "max": self.max,
+        }
+
+
+class Metrics:
+    def __init__(self):
+        # Recording is skipped altogether unless a report was asked for
+        self.enabled = False
+        self.__counters = dict[str, int]()
+        self.__histograms = dict[str, Histogram]()
+        self.__lock = Lock()
+
+        self.__stopped = Event()
+        self.__writer = None
+
+    def enable(self):
+        self.enabled = True
+
+    def count(self, name: str, amount: int = 1):
+        if not self.enabled:
+            return
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + amount
+
+    def observe(self, name: str, seconds: float):
+        if not self.enabled:
+            return
+        with self.__lock:
+            histogram = self.__histograms.get(name)
+            if histogram is None:
+                histogram = self.__histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str) -> Generator[None, None, None]:
+        start_time = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start_time)
+
+    def snapshot(self, clear: bool = False) -> dict:
+        # Cleared when sent to another process, so that the same recordings are never merged twice
+        with self.__lock:
+            snapshot = {
+                "counters": dict(self.__counters),
+                "histograms": {name: histogram.to_dict() for name, histogram in self.__histograms.items()},
+            }
+            if clear:
+                self.__counters.clear()
+                self.__histograms.clear()
+            return snapshot
+
+    def merge(self, snapshot: dict):
+        # Used for metrics recorded in other processes
+        if not self.enabled:
+            return
+        with self.__lock:
+            for name, amount in snapshot["counters"].items():
+                self.__counters[name] = self.__counters.get(name, 0) + amount
+            for name, other in snapshot["histograms"].items():
+                self.__histograms.setdefault(name, Histogram()).merge(other)
+
+    def to_json(self) -> str:
+        with self.__lock:
+            stages = {}
+            for name, histogram in sorted(self.__histograms.items()):
+                stages[name] = {
+                    "count": histogram.count,
+                    "total": histogram.sum,
+                    "mean": histogram.sum / histogram.count if histogram.count else 0.0,
+                    "min": histogram.min if histogram.count else 0.0,
+                    "max": histogram.max,
+                    "p50": histogram.quantile(0.5),
+                    "p90": histogram.quantile(0.9),
+                    "p99": histogram.quantile(0.99),
+                    "buckets": dict(zip(map(str, HISTOGRAM_BUCKETS + (float("inf"),)), histogram.buckets)),
+                }
+            return json.dumps({"counters": dict(sorted(self.__counters.items())), "stages": stages}, indent=2)
+
+    def to_prometheus(self) -> str:
+        lines = []
+        with self.__lock:
+            lines.append(f"# HELP {PROMETHEUS_PREFIX}_stage_seconds Time spent per stage")
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_stage_seconds histogram")
+            for name, histogram in sorted(self.__histograms.items()):
+                cumulative = 0
+                for bound, count in zip(HISTOGRAM_BUCKETS + (float("inf"),), histogram.buckets):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'{PROMETHEUS_PREFIX}_stage_seconds_bucket{{stage="{name}",le="{le}"}} {cumulative}')
+                lines.append(f'{PROMETHEUS_PREFIX}_stage_seconds_sum{{stage="{name}"}} {histogram.sum}')
+                lines.append(f'{PROMETHEUS_PREFIX}_stage_seconds_count{{stage="{name}"}} {histogram.count}')
+
+            lines.append(f"# HELP {PROMETHEUS_PREFIX}_events_total Amount of events per kind")
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_events_total counter")
+            for name, amount in sorted(self.__counters.items()):
+                lines.append(f'{PROMETHEUS_PREFIX}_events_total{{event="{name}"}} {amount}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        is_prometheus = os_path.splitext(path)[1][1:].lower() in PROMETHEUS_EXTS
+        text = self.to_prometheus() if is_prometheus else self.to_json()
+
+        if dir := os_path.dirname(path):
+            makedirs(dir, exist_ok=True)
+        # Replaced at once, so that scrapers never read a half written report
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as file:
+            file.write(text)
+        replace(tmp_path, path)
+
+    def start_periodic(self, path: str, interval: float):
+        def write_periodically():
+            while not self.__stopped.wait(interval):
+                self.write(path)
+
+        self.__stopped.clear()
+        self.__writer = Thread(target=write_periodically, daemon=True)
+        self.__writer.start()
+
+    def stop_periodic(self):
+        if self.__writer is not None:
+            self.__stopped.set()
+            self.__writer.join()
+            self.__writer = None
+
+
+# Shared by every part of a run, so that stages don't need to be handed a reference
+metrics = Metrics()
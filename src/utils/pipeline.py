@@ -0,0 +1,114 @@
+from queue import Empty, Full, Queue
+from threading import Event, Lock, Thread
+from typing import Any, Callable, Iterable
+
+# Seconds between checks of whether the pipeline has been stopped, while waiting on a queue
+POLL_INTERVAL = 0.1
+
+
+class Stage:
+    def __init__(self, func: Callable[[Any], Any], workers: int):
+        self.func = func
+        self.workers = workers
+
+
+class Pipeline:
+    def __init__(self, stages: list[Stage], queue_size: int):
+        self.stages = stages
+        self.queue_size = queue_size
+
+        self.__stopped = Event()
+        self.__error = None
+        self.__done = object()
+
+    def run(self, items: Iterable, on_done: Callable[[Any], None]):
+        # Bounded queues make every stage wait for the next one, so memory stays flat
+        queues = [Queue(self.queue_size) for _ in range(len(self.stages) + 1)]
+
+        threads = [Thread(target=self.__produce, args=(items, queues[0]), daemon=True)]
+        for idx, stage in enumerate(self.stages):
+            next_workers = self.stages[idx + 1].workers if idx + 1 < len(self.stages) else 1
+            remaining = [stage.workers]
+            lock = Lock()
+            for _ in range(stage.workers):
+                args = (stage, queues[idx], queues[idx + 1], remaining, lock, next_workers)
+                threads.append(Thread(target=self.__work, args=args, daemon=True))
+        for thread in threads:
+            thread.start()
+
+        try:
+            while (result := self.__get(queues[-1])) is not self.__done:
+                if result is None:
+                    break
+                on_done(result)
+        except BaseException:
+            # Otherwise every stage would wait on its full queue forever
+            self.__stopped.set()
+            raise
+        finally:
+            for thread in threads:
+                thread.join()
+        if self.__error is not None:
+            raise self.__error
+
+    def cancel(self):
+        self.__stopped.set()
+
+    @property
+    def stopped(self) -> bool:
+        return self.__stopped.is_set()
+
+    def __produce(self, items: Iterable, output: Queue):
+        try:
+            for item in items:
+                if not self.__put(output, item):
+                    return
+        except Exception as error:
+            self.__fail(error)
+            return
+
+        for _ in range(self.stages[0].workers):
+            self.__put(output, self.__done)
+
+    def __work(self, stage: Stage, input: Queue, output: Queue, remaining: list[int], lock: Lock, next_workers: int):
+        while (item := self.__get(input)) is not self.__done:
+            if item is None:
+                return
+            try:
+                result = stage.func(item)
+            except Exception as error:
+                self.__fail(error)
+                return
+            if not self.__put(output, result):
+                return
+
+        # The last worker of a stage to finish lets every worker of the next stage know
+        with lock:
+            remaining[0] -= 1
+            is_last = remaining[0] == 0
+        if is_last:
+            for _ in range(next_workers):
+                self.__put(output, self.__done)
+
+    def __fail(self, error: Exception):
+        if self.__error is None:
+            self.__error = error
+        self.__stopped.set()
+
+    def __put(self, queue: Queue, item) -> bool:
+        while not self.__stopped.is_set():
+            try:
+                queue.put(item, timeout=POLL_INTERVAL)
+                return True
+            except Full:
+                pass
+        return False
+
+    def __get(self, queue: Queue):
+        # None means the pipeline was stopped, so stages shouldn't produce None themselves
+        while not self.__stopped.is_set():
+            try:
+                return queue.get(timeout=POLL_INTERVAL)
+            except Empty:
+                pass
+        return None
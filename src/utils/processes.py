@@ -0,0 +1,30 @@
+import signal
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Callable
+
+
+def init_worker(initializer: Callable | None, initargs: tuple):
+    # Interrupts reach the whole process group, but only the parent decides what is cancelled
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def open_worker_pool(workers: int, initializer: Callable = None, initargs: tuple = ()) -> ProcessPoolExecutor:
+    # Spawned rather than forked, since OpenCV's threads don't survive forking
+    executor = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=get_context("spawn"),
+        initializer=init_worker,
+        initargs=(initializer, initargs),
+    )
+
+    # Started up front with interrupts ignored, which is inherited, so that workers can't die while still starting
+    handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        for _ in range(workers):
+            executor.submit(int)
+    finally:
+        signal.signal(signal.SIGINT, handler)
+    return executor
@@ -1,43 +1,91 @@
+import json
 import math
 import shutil
+import sys
 from time import perf_counter
+from typing import TextIO
 
-MAX_INCREMENT_TIME_LOGS = 32
+# Seconds between redraws of the progress bar
+RENDER_INTERVAL = 0.1
+# Seconds between progress events, when not writing to a terminal
+EVENT_INTERVAL = 1.0
+# Weight of the latest rate sample in the smoothed rate
+RATE_SMOOTHING = 0.3
 
 
 class Progress:
-    def __init__(self, total: int):
+    def __init__(self, total: int, stream: TextIO = None):
         self.current = 0
         self.total = total
-        self.__increment_time_logs = []
+        self.stream = stream or sys.stdout
+        # Schedulers reading the output get JSON lines instead of a redrawn bar
+        self.interactive = self.stream.isatty()
 
-    def increment(self):
-        self.current += 1
-        if len(self.__increment_time_logs) >= MAX_INCREMENT_TIME_LOGS:
-            self.__increment_time_logs.pop(0)
-        self.__increment_time_logs.append(perf_counter())
+        self.start_time = perf_counter()
+        self.rate = 0.0
+        self.__sample_time = self.start_time
+        self.__sample_current = 0
+        self.__report_time = -math.inf
+
+    def increment(self, amount: int = 1):
+        self.current += amount
+
+    def __update_rate(self, now: float):
+        elapsed = now - self.__sample_time
+        if elapsed <= 0:
+            return
+
+        # Smoothed over samples rather than increments, so that it costs the same however fast they come
+        rate = (self.current - self.__sample_current) / elapsed
+        self.rate = rate if self.__sample_current == 0 else RATE_SMOOTHING * rate + (1 - RATE_SMOOTHING) * self.rate
+        self.__sample_time = now
+        self.__sample_current = self.current
+
+    def report(self):
+        now = perf_counter()
+        if now - self.__report_time < (RENDER_INTERVAL if self.interactive else EVENT_INTERVAL):
+            return
+        self.__report_time = now
+        self.__update_rate(now)
+        self.__write(now, False)
+
+    def finish(self):
+        now = perf_counter()
+        self.__update_rate(now)
+        self.__write(now, True)
+
+    def __write(self, now: float, done: bool):
+        if self.interactive:
+            self.stream.write(f"\r{self}" + ("\n" if done else ""))
+            self.stream.flush()
+            return
+
+        eta = self.eta
+        event = {
+            "event": "progress",
+            "current": self.current,
+            "total": self.total,
+            "percent": self.percent,
+            "rate": self.rate,
+            "eta": eta if math.isfinite(eta) else None,
+            "elapsed": now - self.start_time,
+            "done": done,
+        }
+        self.stream.write(json.dumps(event) + "\n")
+        self.stream.flush()
 
     @property
     def eta(self) -> float:
-        if len(self.__increment_time_logs) <= 1:
+        if self.rate <= 0:
             return float("inf")
-
-        time_between = 0
-        for idx in range(1, len(self.__increment_time_logs)):
-            prev_time = self.__increment_time_logs[idx - 1]
-            curr_time = self.__increment_time_logs[idx]
-            time_between += curr_time - prev_time
-        time_between /= len(self.__increment_time_logs)
-        speed = 1 / time_between
-
-        return (self.total - self.current) / speed
+        return max(0, self.total - self.current) / self.rate
 
     @property
     def percent(self) -> float:
         if self.total == 0:
             return 1.0
         else:
-            return self.current / self.total
+            return min(1.0, self.current / self.total)
 
     def bar_str(self, width: int) -> str:
         inner_width = width - 2
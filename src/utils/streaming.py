@@ -0,0 +1,74 @@
+import numpy
+import struct
+import zlib
+from os import path as os_path, remove, replace
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+STREAMABLE_IMAGE_EXTS = ("png", "ppm", "pnm")
+
+
+class PngWriter:
+    def __init__(self, path: str, width: int, height: int):
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        self.file = open(self.tmp_path, "wb")
+        self.compressor = zlib.compressobj(6)
+
+        self.file.write(PNG_SIGNATURE)
+        # 8 bits per channel, truecolor, default compression, filtering and no interlacing
+        self.__write_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+    def __write_chunk(self, chunk_type: bytes, data: bytes):
+        self.file.write(struct.pack(">I", len(data)))
+        self.file.write(chunk_type)
+        self.file.write(data)
+        self.file.write(struct.pack(">I", zlib.crc32(chunk_type + data)))
+
+    def write(self, band: numpy.ndarray):
+        # Every row starts with its filter type, where 0 means unfiltered
+        height, width, _ = band.shape
+        rows = numpy.zeros((height, 1 + width * 3), dtype=numpy.uint8)
+        rows[:, 1:] = band[:, :, ::-1].reshape(height, -1)
+
+        data = self.compressor.compress(rows.tobytes())
+        if data:
+            self.__write_chunk(b"IDAT", data)
+
+    def close(self):
+        self.__write_chunk(b"IDAT", self.compressor.flush())
+        self.__write_chunk(b"IEND", b"")
+        self.file.close()
+        replace(self.tmp_path, self.path)
+
+    def discard(self):
+        # The header already claims every row, so an unfinished image would be truncated
+        self.file.close()
+        remove(self.tmp_path)
+
+
+class PnmWriter:
+    def __init__(self, path: str, width: int, height: int):
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        self.file = open(self.tmp_path, "wb")
+        self.file.write(f"P6\n{width} {height}\n255\n".encode("ascii"))
+
+    def write(self, band: numpy.ndarray):
+        self.file.write(numpy.ascontiguousarray(band[:, :, ::-1]).tobytes())
+
+    def close(self):
+        self.file.close()
+        replace(self.tmp_path, self.path)
+
+    def discard(self):
+        self.file.close()
+        remove(self.tmp_path)
+
+
+def open_band_writer(path: str, width: int, height: int) -> PngWriter | PnmWriter:
+    # Both formats store rows top to bottom, so bands can be written as soon as they're done.
+    # They are written next to the destination, which is only replaced once finished.
+    ext = os_path.splitext(path)[1][1:].lower()
+    if ext == "png":
+        return PngWriter(path, width, height)
+    return PnmWriter(path, width, height)
@@ -0,0 +1,68 @@
+import cv2
+import numpy
+from collections import OrderedDict
+from threading import Lock
+from time import perf_counter
+
+from data.atlas import Atlas
+from utils.metrics import metrics
+
+
+def load_tile(path: str, pixel_size: int) -> numpy.ndarray:
+    start_time = perf_counter()
+    img = cv2.imread(path)
+    decoded_time = perf_counter()
+    tile = cv2.resize(img, (pixel_size, pixel_size))
+
+    metrics.observe("tile.decode", decoded_time - start_time)
+    metrics.observe("tile.resize", perf_counter() - decoded_time)
+    return tile
+
+
+class TileCache:
+    def __init__(self, max_bytes: int, atlas: Atlas = None):
+        self.max_bytes = max_bytes
+        self.atlas = atlas
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.atlas_hits = 0
+
+        self.__tiles = OrderedDict[tuple[str, int], numpy.ndarray]()
+        self.__lock = Lock()
+
+    def get(self, path: str, pixel_size: int) -> numpy.ndarray:
+        key = (path, pixel_size)
+
+        # Tiles in the atlas are already rendered, so they are copied straight from its memory map
+        if self.atlas is not None and self.atlas.pixel_size == pixel_size:
+            tile = self.atlas.get(path)
+            if tile is not None:
+                with self.__lock:
+                    self.atlas_hits += 1
+                metrics.count("tile.atlas_hit")
+                return tile
+
+        with self.__lock:
+            tile = self.__tiles.get(key)
+            if tile is not None:
+                self.__tiles.move_to_end(key)
+                self.hits += 1
+                metrics.count("tile.cache_hit")
+                return tile
+            self.misses += 1
+        metrics.count("tile.cache_miss")
+
+        # Decoded outside of the lock, so that misses don't block each other
+        tile = load_tile(path, pixel_size)
+        tile.flags.writeable = False
+
+        with self.__lock:
+            if key not in self.__tiles and tile.nbytes <= self.max_bytes:
+                self.__tiles[key] = tile
+                self.size += tile.nbytes
+                while self.size > self.max_bytes:
+                    _, evicted = self.__tiles.popitem(last=False)
+                    self.size -= evicted.nbytes
+
+        return tile
@@ -0,0 +1,31 @@
+import cv2
+import re
+from os import path as os_path
+
+DEFAULT_FPS = 25.0
+# Codecs used for each video format, picked since they ship with every OpenCV build
+VIDEO_FOURCCS = {
+    "avi": "MJPG",
+    "mp4": "mp4v",
+    "m4v": "mp4v",
+    "mov": "mp4v",
+    "mkv": "XVID",
+}
+FRAME_SEQUENCE_PATTERN = re.compile(r"%0?\d*d")
+
+
+def is_frame_sequence(path: str) -> bool:
+    # Frame sequences are numbered images, such as "frames/%04d.png"
+    return FRAME_SEQUENCE_PATTERN.search(os_path.basename(path)) is not None
+
+
+def open_video_writer(path: str, fps: float, width: int, height: int) -> cv2.VideoWriter:
+    if is_frame_sequence(path):
+        writer = cv2.VideoWriter(path, cv2.CAP_IMAGES, 0, fps, (width, height))
+    else:
+        ext = os_path.splitext(path)[1][1:].lower()
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*VIDEO_FOURCCS[ext]), fps, (width, height))
+
+    if not writer.isOpened():
+        raise OSError(f"{path} could not be opened for writing")
+    return writer